@@ -0,0 +1,398 @@
+import ssl
+import asyncio
+import collections
+import time
+from connection import H2Connection, ConnectionState
+import logconfig, logging
+from events import *
+from spider import BaseSpider, H2Response, RawResponse, UnprocessedStreamError, ConnectionUnavailableError
+from body import RequestBody
+
+# 基于asyncio的h2爬虫：H2Connection本身不涉及io，这里由事件循环驱动，
+# 单线程即可在多个服务器的连接上同时保持成千上万个流
+
+
+class AsyncStreamAdmission(object):
+    # StreamAdmission的协程版本：按对端MAX_CONCURRENT_STREAMS限制同时打开的流数量，
+    # 超出限制的请求按先后顺序等待，由流关闭或对端settings变化唤醒
+    def __init__(self, conn):
+        super(AsyncStreamAdmission, self).__init__()
+        self.conn = conn
+        # 已获得名额但尚未发送headers的请求数
+        self.reserved = 0
+        self.waiters = collections.deque()
+
+    def _has_slot(self):
+        return self.conn.available_stream_slots > self.reserved
+
+    def _admit(self):
+        while self.waiters and self._has_slot():
+            waiter = self.waiters.popleft()
+            if waiter.done():
+                continue
+            self.reserved += 1
+            waiter.set_result(True)
+
+    async def acquire(self):
+        if not self.waiters and self._has_slot():
+            self.reserved += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 被取消的同时已获得名额，归还给下一个等待者
+                self.release()
+            raise
+
+    def stream_opened(self):
+        self.reserved -= 1
+
+    def release(self):
+        self.reserved -= 1
+        self._admit()
+
+    def stream_closed(self):
+        self._admit()
+
+    settings_changed = stream_closed
+
+    def fail_all(self, error):
+        # 连接不可用时结束所有等待者
+        waiters, self.waiters = self.waiters, collections.deque()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(error)
+
+
+class H2Protocol(asyncio.BufferedProtocol):
+    # 一个h2连接：由事件循环直接将数据读入预分配的缓冲区，交由H2Connection解析，
+    # 再按stream_id把事件分发给各请求的future
+    RECV_BUFFER_SIZE = 2 ** 18
+    # RST_STREAM错误码：对端拒绝处理该流；本端取消该流
+    REFUSED_STREAM = 0x7
+    CANCEL = 0x8
+    # 单个流排队待发送的请求体数据上限，超出时等待对端的WINDOW_UPDATE
+    MAX_PENDING_BODY = 2 ** 18
+
+    def __init__(self, host, port, hpack_policy=None):
+        super(H2Protocol, self).__init__()
+        self.host = host
+        self.port = port
+        self.conn = H2Connection(hpack_policy=hpack_policy)
+        self.admission = AsyncStreamAdmission(self.conn)
+        self.transport = None
+        # 进行中的请求 {stream_id: (RawResponse, future)}
+        self.responses = {}
+        self.closed = False
+        self.last_active = time.monotonic()
+        # 等待发送窗口的上传协程 {stream_id: future}
+        self._writers = {}
+        self._recv_buffer = bytearray(self.RECV_BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
+
+    @property
+    def active_count(self):
+        return len(self.responses)
+
+    @property
+    def usable(self):
+        return not self.closed and self.conn.status != ConnectionState.CLOSED
+
+    def _flush(self):
+        buffers = self.conn.buffers_to_send()
+        if buffers and not self.transport.is_closing():
+            self.transport.writelines(buffers)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self._flush()
+
+    def get_buffer(self, sizehint):
+        return self._recv_view
+
+    def buffer_updated(self, nbytes):
+        self.last_active = time.monotonic()
+        try:
+            events = self.conn.receive_data(self._recv_view[:nbytes])
+            self._dispatch(events)
+            self._flush()
+        except Exception as e:
+            # 协议错误、hpack解码失败、帧格式错误等，连接状态已不可信，结束所有请求
+            logging.info('connection(%s:%s) failed: %r' % (self.host, self.port, e))
+            self.transport.close()
+            self._fail_all(e)
+            return
+        if self.conn.status == ConnectionState.CLOSED and not self.responses:
+            # 收到goaway后，已被对端接受的请求全部完成，关闭连接
+            self.close()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self._fail_all(exc or ConnectionResetError('connection(%s:%s) closed by remote. '
+                                                   % (self.host, self.port)))
+
+    def _fail_all(self, error):
+        self.closed = True
+        responses, self.responses = self.responses, {}
+        for response, future in responses.values():
+            response.error = error
+            if not future.done():
+                future.set_exception(error)
+        self.admission.fail_all(error)
+        self._wake_writers()
+
+    def _wake_writers(self, stream_id=0):
+        # 窗口更新、响应结束或连接关闭时唤醒该流的上传协程，stream_id为0时唤醒全部
+        if stream_id:
+            waiters = [self._writers.pop(stream_id)] if stream_id in self._writers else []
+        else:
+            waiters, self._writers = list(self._writers.values()), {}
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _finish(self, stream_id, error=None):
+        item = self.responses.pop(stream_id, None)
+        if item is None:
+            return
+        response, future = item
+        response.completed = True
+        response.error = error
+        self._wake_writers(stream_id)
+        if future.done():
+            return
+        if error is None:
+            future.set_result(response)
+        else:
+            future.set_exception(error)
+
+    def _dispatch(self, events):
+        for e in events:
+            if isinstance(e, (StreamClosed, SettingsReceived)):
+                self.admission.stream_closed()
+                if getattr(e, 'error_code', None) is not None:
+                    # 对端在该流上违反协议，本端已重置该流
+                    self._finish(e.stream_id, ConnectionError(
+                        'stream %s was reset by local(error code: %s). ' % (e.stream_id, e.error_code)))
+                continue
+            elif isinstance(e, WindowUpdated):
+                self._wake_writers(e.stream_id)
+                continue
+            elif isinstance(e, HeadersReceived):
+                item = self.responses.get(e.stream_id)
+                if item is not None:
+                    item[0].set_headers(e.headers)
+            elif isinstance(e, DataReceived):
+                item = self.responses.get(e.stream_id)
+                if item is not None:
+                    try:
+                        item[0].write(e)
+                    except Exception as error:
+                        # 响应体过大，放弃该流
+                        if e.stream_id in self.conn.streams:
+                            self.conn.send_rst_stream(e.stream_id, error_code=self.CANCEL)
+                        self._finish(e.stream_id, error)
+                self.conn.ack_data_received(e.flow_window_length, e.stream_id)
+            elif isinstance(e, RstStreamReceived):
+                error_class = (UnprocessedStreamError if e.error_code == self.REFUSED_STREAM
+                               else ConnectionError)
+                self._finish(e.stream_id, error_class(
+                    'stream %s was reset(error code: %s). ' % (e.stream_id, e.error_code)))
+                continue
+            elif isinstance(e, GoawayReceived):
+                # id大于last_stream_id的请求未被对端处理，由调用方在新连接上重放
+                for stream_id in [i for i in self.responses if i > e.last_stream_id]:
+                    self._finish(stream_id, UnprocessedStreamError(
+                        'stream %s was not processed by %s:%s before goaway. '
+                        % (stream_id, self.host, self.port)))
+                self.admission.fail_all(ConnectionUnavailableError(
+                    'connection(%s:%s) received goaway. ' % (self.host, self.port)))
+                continue
+            if getattr(e, 'end_stream', False):
+                self._finish(e.stream_id)
+
+    async def submit(self, template, path, body=None, max_size=None):
+        # 按请求模板发送请求头部，有请求体（RequestBody）时上传请求体，等待该流结束，返回RawResponse
+        await self.admission.acquire()
+        if not self.usable:
+            self.admission.release()
+            raise ConnectionUnavailableError('connection(%s:%s) is closed. ' % (self.host, self.port))
+        stream_id = self.conn.get_next_available_stream()
+        if not stream_id:
+            self.admission.release()
+            raise ValueError('stream ids of connection(%s:%s) are exhausted. '
+                             % (self.host, self.port))
+        response = RawResponse(max_size=max_size)
+        future = asyncio.get_running_loop().create_future()
+        self.responses[stream_id] = (response, future)
+        self.conn.send_request_headers(stream_id, template, path, end_stream=body is None,
+                                       extra=body.headers() if body is not None else ())
+        self.admission.stream_opened()
+        self._flush()
+        try:
+            if body is not None:
+                await self._send_body(stream_id, future, body)
+            return await future
+        except (asyncio.CancelledError, Exception):
+            # 调用方取消请求或读取请求体失败时重置该流，释放服务器端资源和本端的流名额
+            self._cancel_stream(stream_id)
+            raise
+
+    def _cancel_stream(self, stream_id):
+        if self.responses.pop(stream_id, None) is None:
+            return
+        if self.usable and stream_id in self.conn.streams:
+            self.conn.send_rst_stream(stream_id, error_code=self.CANCEL)
+            self.admission.stream_closed()
+            self._flush()
+
+    async def _send_body(self, stream_id, future, body):
+        # 逐块发送请求体，排队的数据达到MAX_PENDING_BODY时等待窗口更新；
+        # 对端提前结束响应或连接不可用时停止上传
+        for chunk in body.chunks():
+            if not await self._wait_writable(stream_id, future):
+                return
+            self._send_data(stream_id, chunk)
+        if await self._wait_writable(stream_id, future):
+            self._send_data(stream_id, b'', end_stream=True)
+
+    async def _wait_writable(self, stream_id, future):
+        while (not future.done() and not self.closed
+               and self.conn.pending_data_size(stream_id) >= self.MAX_PENDING_BODY):
+            waiter = self._writers[stream_id] = asyncio.get_running_loop().create_future()
+            await waiter
+        if future.done() or self.closed or stream_id not in self.conn.streams:
+            if not self.closed and stream_id in self.conn.streams:
+                # 响应已结束但本端尚未结束该流，重置以释放流名额
+                self.conn.send_rst_stream(stream_id, error_code=self.CANCEL)
+                self.admission.stream_closed()
+                self._flush()
+            return False
+        return True
+
+    def _send_data(self, stream_id, data, end_stream=False):
+        if self.conn.send_data(stream_id, data, end_stream=end_stream):
+            self.admission.stream_closed()
+        self._flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.transport is not None and not self.transport.is_closing():
+            self.conn.close_connection()
+            self._flush()
+            self.transport.close()
+
+
+class AsyncH2Spider(BaseSpider):
+    # H2Spider的asyncio版本，请求头部构建、url解析和重放策略与H2Spider共用BaseSpider，
+    # 只提供协程接口
+    # 使用方法：
+    #     async with AsyncH2Spider() as spider:
+    #         responses = await asyncio.gather(*(spider.get(url) for url in urls))
+    def __init__(self, max_connection=64, timeout=10, max_content_size=None, hpack_policy=None):
+        super(AsyncH2Spider, self).__init__(max_connection=max_connection, timeout=timeout,
+                                            max_content_size=max_content_size,
+                                            hpack_policy=hpack_policy)
+        # {(host, port): H2Protocol}
+        self.protocols = {}
+        # 正在建立的连接 {(host, port): future}，避免并发请求重复建立同一连接
+        self._connecting = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def request(self, method, url=None, headers=None, proxy=None, data=None):
+        method = method.upper()
+        host = self._parse_host(url)
+        port = self._parse_port(url)
+        template, path = self._build_request(method, url, headers)
+        body = RequestBody(data) if data is not None else None
+        replays = 0
+        while True:
+            try:
+                protocol = await self._get_protocol(host, port)
+                r = await protocol.submit(template, path, body=body,
+                                          max_size=self.max_content_size)
+                break
+            except (OSError, ValueError) as e:
+                if not self._can_replay(method, e, replays) or (body is not None and not body.rewind()):
+                    raise
+                # 连接收到goaway，请求未被处理，在新连接上重放
+                replays += 1
+                logging.info('replay %s %s(%s). ' % (method, url, e))
+        return H2Response(r.headers, r.data, self.max_content_size)
+
+    async def get(self, url, headers=None, proxy=None):
+        return await self.request(method='GET', url=url, headers=headers, proxy=proxy)
+
+    # headers保持为第二个位置参数（与早期版本的post(url, headers)兼容），请求体通过data关键字参数传入
+    async def post(self, url, headers=None, data=None):
+        return await self.request('POST', url, headers, data=data)
+
+    async def put(self, url, headers=None, data=None):
+        return await self.request('PUT', url, headers, data=data)
+
+    async def _get_protocol(self, host, port):
+        origin = (host, port)
+        protocol = self.protocols.get(origin)
+        if protocol is not None and protocol.usable:
+            return protocol
+        connecting = self._connecting.get(origin)
+        if connecting is not None:
+            return await asyncio.shield(connecting)
+        loop = asyncio.get_running_loop()
+        connecting = self._connecting[origin] = loop.create_future()
+        try:
+            self.protocols.pop(origin, None)
+            self._evict_idle()
+            protocol = await self._open_connection(host, port)
+            self.protocols[origin] = protocol
+            connecting.set_result(protocol)
+        except BaseException as e:
+            connecting.set_exception(e)
+            # 没有其他等待者时避免"exception was never retrieved"警告
+            connecting.exception()
+            raise
+        finally:
+            self._connecting.pop(origin, None)
+        return protocol
+
+    async def _open_connection(self, host, port):
+        context = ssl.create_default_context()
+        context.set_alpn_protocols(['h2'])
+        loop = asyncio.get_running_loop()
+        _, protocol = await asyncio.wait_for(
+            loop.create_connection(lambda: H2Protocol(host, port, self.hpack_policy), host, port,
+                                   ssl=context, server_hostname=host),
+            self.timeout)
+        return protocol
+
+    def _evict_idle(self):
+        # 连接数达到上限时关闭空闲最久的连接，没有空闲连接时允许暂时超出上限
+        if len(self.protocols) < self.max_connection:
+            return
+        idle = [(p.last_active, origin) for origin, p in self.protocols.items()
+                if not p.active_count]
+        if not idle:
+            return
+        _, origin = min(idle)
+        self.protocols.pop(origin).close()
+
+    def header_stats(self):
+        return {origin: [protocol.conn.header_stats()] for origin, protocol in self.protocols.items()}
+
+    async def close(self):
+        protocols, self.protocols = self.protocols, {}
+        for protocol in protocols.values():
+            protocol.close()
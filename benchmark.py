@@ -0,0 +1,295 @@
+# 性能测试脚本（不依赖网络），用于对比各项优化前后的差异
+# 使用方法：python benchmark.py
+import socket
+import threading
+import time
+import tracemalloc
+
+from hpack.hpack import Encoder
+
+from connection import H2Connection
+from frame import *
+from spider import H2Socket, H2Response, H2Spider
+from events import DataReceived
+
+MB = 2 ** 20
+
+
+def _build_response_frames(stream_id, body_size, chunk_size=16384):
+    # 构造服务器端响应的原始字节流：settings + headers + 若干data帧
+    encoder = Encoder()
+    frames = [SettingsFrame(0),
+              HeadersFrame(stream_id,
+                           encoder.encode([(':status', '200'),
+                                           ('content-type', 'image/jpeg')]),
+                           flags=('END_HEADERS',))]
+    body = b'x' * chunk_size
+    for sent in range(0, body_size, chunk_size):
+        flags = ('END_STREAM',) if sent + chunk_size >= body_size else ()
+        frames.append(DataFrame(stream_id, body, flags=flags))
+    return b''.join(f.serialize() for f in frames)
+
+
+def _new_connection():
+    # 模拟的服务器端不遵守流控，使用最大窗口避免窗口耗尽
+    conn = H2Connection({SettingsFrame.INITIAL_WINDOW_SIZE: 2 ** 31 - 1})
+    conn.initiate_connection()
+    conn.send_headers(1, {':method': 'GET', ':path': '/', ':scheme': 'https',
+                          ':authority': 'localhost'}, end_stream=True)
+    conn.data_to_send()
+    return conn
+
+
+def _run_recv(wire, use_recv_into, min_buffer=1024):
+    # 通过socketpair模拟网络传输，统计接收路径的内存分配情况
+    # 两种路径使用同样的方式计量：每次接收（读socket并交由conn解析）前后由tracemalloc
+    # 记录新分配内存的峰值，峰值增长达到min_buffer字节的接收计为一次缓冲区分配
+    server, client = socket.socketpair()
+    writer = threading.Thread(target=server.sendall, args=(wire,))
+    conn = _new_connection()
+    h2sock = H2Socket('localhost', sock=client)
+    recv_calls = 0
+    buffer_allocations = 0
+    bytes_allocated = 0
+    max_peak = 0
+    received = 0
+    tracemalloc.start()
+    t1 = time.perf_counter()
+    writer.start()
+    finished = False
+    try:
+        while not finished:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            if use_recv_into:
+                events = h2sock.receive_into(conn)
+            else:
+                events = conn.receive_data(h2sock.recv(65535))
+            _, peak = tracemalloc.get_traced_memory()
+            recv_calls += 1
+            max_peak = max(max_peak, peak)
+            if peak - before >= min_buffer:
+                buffer_allocations += 1
+                bytes_allocated += peak - before
+            for e in events:
+                if isinstance(e, DataReceived):
+                    received += e.data_length
+                    conn.ack_data_received(e.flow_window_length, e.stream_id)
+                    conn.data_to_send()
+                    finished = e.end_stream
+            # 事件持有帧缓冲区的视图，下一次接收前释放，帧缓冲区才能原地扩容和整理
+            events = e = None
+        t2 = time.perf_counter()
+    finally:
+        tracemalloc.stop()
+        client.close()
+        writer.join()
+        server.close()
+    mb = received / MB
+    return {
+        'recv calls/MB': recv_calls / mb,
+        'buffer allocations/MB': buffer_allocations / mb,
+        'bytes allocated by receive/MB': bytes_allocated / mb,
+        # 每次接收前都会重置峰值，这里取各次接收峰值中的最大值
+        'peak traced memory(KB)': max_peak / 1024,
+        'MB/s': mb / (t2 - t1),
+    }
+
+
+def bench_recv(body_size=8 * MB):
+    # 对比recv(65535)与recv_into预分配缓冲区两种接收路径
+    wire = _build_response_frames(1, body_size)
+    for name, use_recv_into in (('recv', False), ('recv_into', True)):
+        result = _run_recv(wire, use_recv_into)
+        print('%-10s %s' % (name, ', '.join('%s: %.1f' % item
+                                             for item in result.items())))
+
+
+def bench_frames(count=100000):
+    # 帧的解析与序列化速度（帧/秒）以及单个帧对象的内存占用
+    samples = [DataFrame(1, b'x' * 1024, flags=('END_STREAM',)),
+               HeadersFrame(1, b'h' * 64, flags=('END_HEADERS',)),
+               WindowUpdateFrame(1, 65535),
+               SettingsFrame(0, flags=('ACK',)),
+               PingFrame(0, flags=('ACK',))]
+    wires = [f.serialize() for f in samples]
+    t1 = time.perf_counter()
+    for i in range(count):
+        samples[i % len(samples)].serialize()
+    t2 = time.perf_counter()
+    print('serialize: %.0f frames/s' % (count / (t2 - t1)))
+
+    buffer = b''.join(wires) * (count // len(wires))
+    view = memoryview(buffer)
+    t1 = time.perf_counter()
+    offset = 0
+    flags_checked = 0
+    while offset < len(buffer):
+        frame, length = Frame.parse_frame_header(buffer, offset)
+        frame.parse_body(view[offset + 9:offset + 9 + length])
+        if 'END_STREAM' in frame.flags:
+            flags_checked += 1
+        offset += 9 + length
+    t2 = time.perf_counter()
+    print('parse: %.0f frames/s' % (count / (t2 - t1)))
+
+    # 批量扫描：一次遍历建立全部帧的索引，再按需创建帧对象
+    t1 = time.perf_counter()
+    index, _ = scan_frames(buffer)
+    t2 = time.perf_counter()
+    for type, flags, stream_id, offset, length in index:
+        frame = Frame.from_fields(type, flags, stream_id, length)
+        frame.parse_body(view[offset:offset + length])
+    t3 = time.perf_counter()
+    print('scan: %.0f frames/s, scan + parse: %.0f frames/s' % (
+        len(index) / (t2 - t1), len(index) / (t3 - t1)))
+
+    # WINDOW_UPDATE：创建帧对象序列化 vs 使用缓存的序列化结果
+    t1 = time.perf_counter()
+    for i in range(count):
+        WindowUpdateFrame(i & 0xFF | 1, 32768).serialize()
+    t2 = time.perf_counter()
+    for i in range(count):
+        window_update_bytes(i & 0xFF | 1, 32768)
+    t3 = time.perf_counter()
+    print('window update: frame object %.0f/s, cached bytes %.0f/s' % (
+        count / (t2 - t1), count / (t3 - t2)))
+
+    for cls, args in ((DataFrame, (1,)), (WindowUpdateFrame, (1, 1)),
+                      (HeadersFrame, (1,))):
+        tracemalloc.start()
+        frames = [cls(*args) for _ in range(10000)]
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('%s: %.0f bytes/frame' % (cls.__name__, current / len(frames)))
+
+
+def bench_streams(count=100000):
+    # 单个流对象的内存占用以及一次完整请求生命周期（状态转换与窗口更新）的耗时
+    from stream import H2Stream
+    tracemalloc.start()
+    streams = [H2Stream(i * 2 + 1, 65535, 65535, 16384, 16384)
+               for i in range(count)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('H2Stream: %.0f bytes/stream' % (current / count))
+
+    encoder = Encoder()
+    headers = {':method': 'GET', ':path': '/', ':scheme': 'https',
+               ':authority': 'localhost'}
+    data = DataFrame(1, b'x' * 1024, flags=('END_STREAM',))
+    data.body_len = 1024
+    t1 = time.perf_counter()
+    for stream in streams:
+        stream.send_headers(headers, encoder, end_stream=True)
+    t2 = time.perf_counter()
+    for stream in streams:
+        stream.receive_data(data)
+        stream.ack_data_received(1024)
+    t3 = time.perf_counter()
+    print('send_headers: %.0f streams/s, receive_data + ack: %.0f streams/s' % (
+        count / (t2 - t1), count / (t3 - t2)))
+
+
+def bench_send_data(body_size=32 * MB, streams=4):
+    # 多个流同时上传请求体：对端每收到一个窗口的数据就归还连接级和流级窗口，
+    # 统计发送调度的吞吐量以及各流得到的发送量是否均衡
+    from template import RequestTemplate
+    conn = H2Connection()
+    conn.initiate_connection()
+    conn.receive_data(SettingsFrame(0).serialize())
+    template = RequestTemplate('POST', 'localhost')
+    body = b'x' * (body_size // streams)
+    stream_ids = [i * 2 + 1 for i in range(streams)]
+    for stream_id in stream_ids:
+        conn.send_request_headers(stream_id, template, '/', end_stream=False)
+        conn.send_data(stream_id, body, end_stream=True)
+    conn.data_to_send()
+    sent = dict.fromkeys(stream_ids, 0)
+    halfway = None
+    t1 = time.perf_counter()
+    while any(conn.pending_data_size(stream_id) for stream_id in stream_ids):
+        # 按各流已发送的量归还窗口，模拟对端的WINDOW_UPDATE
+        updates = [WindowUpdateFrame(0, 65535)]
+        for stream_id in stream_ids:
+            if conn.pending_data_size(stream_id):
+                updates.append(WindowUpdateFrame(stream_id, 65535))
+        conn.receive_data(b''.join(f.serialize() for f in updates))
+        for stream_id, length in _data_frame_lengths(conn.data_to_send()):
+            sent[stream_id] += length
+        if halfway is None and sum(sent.values()) >= body_size // 2:
+            halfway = dict(sent)
+    t2 = time.perf_counter()
+    print('send_data: %.0f MB/s, sent per stream at halfway(KB): %s' % (
+        body_size / MB / (t2 - t1), sorted(v // 1024 for v in halfway.values())))
+
+
+def _data_frame_lengths(wire):
+    # 从发送的字节流中取出各DATA帧的(stream_id, 长度)
+    offset = 0
+    while offset < len(wire):
+        frame, length = Frame.parse_frame_header(wire, offset)
+        if isinstance(frame, DataFrame):
+            yield frame.stream_id, length
+        offset += 9 + length
+
+
+def bench_headers(count=50000):
+    # 请求头部的hpack编码：每次编码完整头部 vs 按请求模板只编码:path
+    spider = H2Spider()
+    urls = ['https://localhost/item/%d' % i for i in range(count)]
+    encoder = H2Connection().encoder
+    t1 = time.perf_counter()
+    for url in urls:
+        headers = dict(spider.DEFAULT_HEADERS)
+        headers[':authority'] = 'localhost'
+        headers[':method'] = 'GET'
+        headers[':path'] = spider._parse_path(url)
+        encoder.encode(headers)
+    t2 = time.perf_counter()
+    conn = H2Connection()
+    for url in urls:
+        conn.encode_request_headers(*spider._build_request('GET', url, None))
+    t3 = time.perf_counter()
+    print('header encoding: full %.0f requests/s, template %.0f requests/s' % (
+        count / (t2 - t1), count / (t3 - t2)))
+
+
+def bench_response(count=20000, body_size=64 * 1024):
+    # H2Response的两种使用方式：只读取status/headers，以及读取完整的content和text
+    headers = [(':status', '200'), ('content-type', 'text/html; charset=utf-8'),
+               ('content-length', str(body_size)), ('server', 'benchmark')]
+    body = bytearray(b'x' * body_size)
+    t0 = time.perf_counter()
+    for _ in range(count):
+        H2Response(headers, body).status
+    t1 = time.perf_counter()
+    for _ in range(count):
+        response = H2Response(headers, body)
+        response.status
+        response.headers.get('content-type')
+    t2 = time.perf_counter()
+    for _ in range(count):
+        response = H2Response(headers, body)
+        response.status
+        response.text
+    t3 = time.perf_counter()
+    print('H2Response: status only %.0f responses/s, header only %.0f responses/s, '
+          'full body %.0f responses/s' % (count / (t1 - t0), count / (t2 - t1), count / (t3 - t2)))
+
+    # 多次访问text只解码一次
+    response = H2Response(headers, body)
+    t1 = time.perf_counter()
+    for _ in range(count):
+        response.text
+    t2 = time.perf_counter()
+    print('H2Response: cached text %.0f accesses/s' % (count / (t2 - t1)))
+
+
+if __name__ == '__main__':
+    bench_recv()
+    bench_frames()
+    bench_streams()
+    bench_headers()
+    bench_send_data()
+    bench_response()
@@ -0,0 +1,85 @@
+import os
+import stat
+from collections.abc import Mapping
+
+# 请求体：统一bytes、文件对象和迭代器三种形式，按块产生数据，
+# 已知长度时用于设置content-length，重放请求时尝试回到起始位置
+
+
+class RequestBody(object):
+    # 从文件对象读取时每块的大小
+    CHUNK_SIZE = 2 ** 16
+
+    def __init__(self, data):
+        super(RequestBody, self).__init__()
+        if isinstance(data, Mapping):
+            # 字典也可以迭代，但迭代得到的是键，不能当作请求体的数据块；表单等编码需由调用方完成
+            raise TypeError('request body must be bytes, str, a file object or an iterator, got %s; '
+                            'encode mappings (e.g. urllib.parse.urlencode or json.dumps) before sending. '
+                            % type(data).__name__)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.data = data
+        # 请求体长度，未知时为None
+        self.length = None
+        # 文件对象的起始位置，用于重放时回退
+        self._start = None
+        self._started = False
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self.length = memoryview(data).nbytes
+        elif hasattr(data, 'read'):
+            self.length = self._file_length(data)
+            try:
+                self._start = data.tell() if data.seekable() else None
+            except (AttributeError, OSError, ValueError):
+                self._start = None
+        elif not hasattr(data, '__iter__'):
+            raise ValueError('request body must be bytes, str, a file object or an iterator, got %s. '
+                             % type(data).__name__)
+
+    @staticmethod
+    def _file_length(fp):
+        # 普通文件按文件大小与当前位置计算剩余长度，其他文件对象长度未知
+        try:
+            st = os.fstat(fp.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            return max(st.st_size - fp.tell(), 0)
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def chunks(self):
+        # 依次产生请求体的数据块（bytes-like）
+        self._started = True
+        data = self.data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            if len(data):
+                yield memoryview(data).cast('B')
+        elif hasattr(data, 'read'):
+            while True:
+                chunk = data.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        else:
+            for chunk in data:
+                if chunk:
+                    yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+    def rewind(self):
+        # 回到请求体的起始位置，以便在新连接上重放请求；无法回退时返回False
+        if not self._started or isinstance(self.data, (bytes, bytearray, memoryview)):
+            return True
+        if self._start is None:
+            return False
+        try:
+            self.data.seek(self._start)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def headers(self):
+        # 随请求发送的与请求体相关的头部，长度已知时为content-length
+        if self.length is None:
+            return ()
+        return (('content-length', str(self.length)),)
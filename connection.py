@@ -18,7 +18,8 @@ try:
 except:
     from events import *
 
-from hpack.hpack import Encoder, Decoder
+from hpack.hpack import Encoder, Decoder, INDEX_NONE, INDEX_NEVER
+import collections
 import logging, logconfig
 from windows import WindowManager
 
@@ -28,54 +29,111 @@ class ConnectionState(object):
     CLOSED = 2
 
 # 用于处理headers帧以及continuation帧的缓冲区
+# 数据保存在可增长的bytearray中，通过读偏移量offset记录已解析的位置，
+# 仅在已读数据较多时才整理（compact）缓冲区，避免每解析一帧就复制剩余数据
 class FrameBuffer(object):
 
     CONTINUATION_BACKLOG = 64
+    # 已读数据超过该值且超过缓冲区一半时才进行整理
+    COMPACT_THRESHOLD = 2 ** 16
+
     def __init__(self, max_frame_size):
         super(FrameBuffer, self).__init__()
-        self.data = b''
+        self.data = bytearray()
+        self.offset = 0
         self.max_frame_size = max_frame_size
-    def add(self, data):
-        self.data += data
         self.header_blocks = []
 
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if len(self.data) < 9:
-            # 接收到的头部数据不完整，保留至下一次解析
-            raise StopIteration()
-        header = self.data[0:9]
+    def add(self, data):
+        self._compact()
         try:
-            frame, length = Frame.parse_frame_header(header)
-        except:
-            raise ValueError('Frame header parse failed. ')
-        if len(self.data) < length + 9:
-            # 说明缓冲区接收到的数据payload不完整，保留至下一次解析
-            raise StopIteration()
-        # 暂时未配置push_promise 帧
-        # 对被分块的帧合并成一个总headers
-        frame.parse_body(self.data[9:9+length])
+            self.data += data
+        except BufferError:
+            # 仍有帧持有旧缓冲区的memoryview，此时旧缓冲区不能扩容，
+            # 将未解析的数据复制到新缓冲区，旧缓冲区由持有者自行释放
+            self.data = self.data[self.offset:] + data
+            self.offset = 0
+
+    def _compact(self):
+        # 数据已全部解析，或已读数据占比过大时，丢弃已读部分
+        if self.offset == 0:
+            return
+        if (self.offset == len(self.data) or
+                (self.offset > self.COMPACT_THRESHOLD and
+                 self.offset * 2 > len(self.data))):
+            try:
+                del self.data[:self.offset]
+            except BufferError:
+                self.data = self.data[self.offset:]
+            self.offset = 0
+
+    def __len__(self):
+        # 未解析的数据长度
+        return len(self.data) - self.offset
+
+    def __iter__(self):
+        # 先一次性扫描出缓冲区内所有完整帧的索引，再逐个创建帧对象，
+        # 未实现或需忽略的帧类型（PRIORITY、扩展帧等）不会被创建
+        index, self.offset = scan_frames(self.data, self.offset)
+        if not index:
+            return
+        view = memoryview(self.data)
+        for type, flags, stream_id, offset, length in index:
+            if length > self.max_frame_size:
+                raise ValueError('frame size %s exceeds max frame size %s.'
+                                 % (length, self.max_frame_size))
+            if type not in FRAMES:
+                continue
+            frame = Frame.from_fields(type, flags, stream_id, length)
+            # 暂时未配置push_promise 帧
+            # payload以memoryview的形式传入，避免大块DATA帧的复制
+            frame.parse_body(view[offset:offset + length])
+            frame = self._merge_header_blocks(frame)
+            if frame is not None:
+                yield frame
+
+    def _merge_header_blocks(self, frame):
+        # 对被分块的帧合并成一个总headers，headers未结束时返回None
         if self.header_blocks:
             if frame.stream_id != self.header_blocks[0].stream_id:
                 raise ValueError('Invalid continuation frame for its headers.')
             self.header_blocks.append(frame)
 
-            if 'END_HEADERS' in frame.flags:
+            if frame.flag_bits & FLAG_END_HEADERS:
                 self.header_blocks[0].add_flag('END_HEADERS')
                 frame = self.header_blocks[0]
-                frame.data = b''.join([f.d for f in self.header_blocks])
+                frame.data = b''.join([f.data for f in self.header_blocks])
                 self.header_blocks = []
             else:
                 frame = None
         elif (isinstance(frame, (HeadersFrame, PushPromiseFrame)) and
-                'END_HEADERS' not in frame.flags):
+                not frame.flag_bits & FLAG_END_HEADERS):
             self.header_blocks.append(frame)
+            frame = None
         if len(self.header_blocks) > self.CONTINUATION_BACKLOG:
             raise ValueError('too many continuation frames.')
-        self.data = self.data[9+length:]
-        return frame if frame is not None else self.__next__()
+        return frame
+
+
+class HpackPolicy(object):
+    # 头部压缩策略
+    # header_table_size: 通告给对端的HEADER_TABLE_SIZE，即对端编码响应头部时可使用的动态表大小
+    # max_encoder_table_size: 本端编码器动态表的上限，实际使用该值与对端通告值中的较小者
+    # never_indexed: 以never indexed方式编码的头部名称，这些头部不进入动态表，中间节点也不得将其加入索引
+    DEFAULT_NEVER_INDEXED = ('authorization', 'proxy-authorization', 'cookie')
+
+    def __init__(self, header_table_size=65536, max_encoder_table_size=65536, never_indexed=None):
+        super(HpackPolicy, self).__init__()
+        self.header_table_size = header_table_size
+        self.max_encoder_table_size = max_encoder_table_size
+        if never_indexed is None:
+            never_indexed = self.DEFAULT_NEVER_INDEXED
+        self.never_indexed = frozenset(name.lower() for name in never_indexed)
+
+    def mark(self, headers):
+        # 为头部加上是否never indexed的标记，返回(name, value, sensitive)的元组
+        never_indexed = self.never_indexed
+        return tuple((name, value, name in never_indexed) for name, value in headers)
 
 
 # h2连接对象，同时用于管理整个流
@@ -88,16 +146,41 @@ class H2Connection(object):
     DEFAULT_MAX_HEADER_LIST_SIZE = 2 ** 16
     # 最大窗口限制
     MAX_FLOW_CONTROL_WINDOW = 2 ** 31 - 1
+    # 对端最大帧payload长度的合法范围
+    MIN_MAX_FRAME_SIZE = 2 ** 14
+    MAX_MAX_FRAME_SIZE = 2 ** 24 - 1
+    # 错误码
+    PROTOCOL_ERROR = 0x1
+    FLOW_CONTROL_ERROR = 0x3
+    # 缓存hpack编码结果的请求模板数量上限
+    MAX_CACHED_HEADER_BLOCKS = 64
 
     status = ConnectionState.IDLE
 
-    def __init__(self, local_settings=None):
+    def __init__(self, local_settings=None, hpack_policy=None):
         super(H2Connection, self).__init__()
         self.encoder = Encoder()
         self.decoder = Decoder()
+        self.hpack_policy = hpack_policy if hpack_policy is not None else HpackPolicy()
+        # 头部字节数统计：压缩前（名称与值的长度之和）和压缩后（头部块的长度）
+        self.sent_header_bytes = 0
+        self.sent_header_bytes_encoded = 0
+        self.received_header_bytes = 0
+        self.received_header_bytes_encoded = 0
+        # 存活（未关闭）的流，{stream_id: H2Stream}
         self.streams = {}
-        self.local_settings = Settings(local_settings)
+        # 下一个可用的客户端流id（单调递增的奇数），以及已开启过的最大流id
+        self.next_stream_id = 1
+        self.highest_stream_id = 0
+        # 未指定HEADER_TABLE_SIZE时按压缩策略通告
+        settings = {SettingsFrame.HEADER_TABLE_SIZE: self.hpack_policy.header_table_size}
+        settings.update(local_settings or {})
+        self.local_settings = Settings(settings)
         self.remote_settings = Settings()
+        # 是否已收到对端的第一个settings帧
+        self.remote_settings_received = False
+        # 对端goaway中的last_stream_id，未收到goaway时为None
+        self.goaway_last_stream_id = None
         # 接收数据窗口
         self.inbound_flow_control_window = self.local_settings.initial_window_size
 
@@ -108,8 +191,12 @@ class H2Connection(object):
         self.__set_decoder()
         # 接收数据缓冲区
         self.inbound_buffer = FrameBuffer(self.local_settings.max_frame_size)
-        # 待发送的数据缓冲区
-        self._data_to_send = b''
+        # 待发送的数据缓冲区，按顺序保存各帧的首部和payload，发送时再统一写出
+        self._data_to_send = []
+        # 请求模板的hpack编码缓存 {RequestTemplate: (动态表签名, 伪头部编码, 普通头部编码)}
+        self._header_blocks = {}
+        # 因发送窗口不足而排队的请求体数据 {stream_id: deque([[memoryview, end_stream], ...])}
+        self._pending_data = {}
 
         self.__dispatch_table = {
             SettingsFrame: self._receive_settings_frame,
@@ -128,7 +215,8 @@ class H2Connection(object):
         for setting, value in self.local_settings.items():
             f.settings[setting] = value
         logging.info('stream_id:0 send settings frame.(%s)' % f.settings)
-        self._data_to_send += pre_message + f.serialize()
+        self._data_to_send.append(pre_message)
+        self._prepare_for_send([f])
 
 
     def send_headers(self, stream_id, headers,
@@ -139,125 +227,317 @@ class H2Connection(object):
                      exclusive=False,
                      stream_dependency=0x0,
                      weight=16):
+        stream = self._stream_for_headers(stream_id)
+        if isinstance(headers, dict):
+            # 伪头部需排在普通头部之前
+            headers = sorted(headers.items(), key=lambda x: not x[0].startswith(':'))
+        headers = self.hpack_policy.mark(headers)
+        header_block = self.encoder.encode(headers)
+        self._count_sent_headers(sum(len(name) + len(value) for name, value, _ in headers),
+                                 len(header_block))
+        frames = stream.send_header_block(header_block,
+                                          end_stream,
+                                          padded,
+                                          padded_length,
+                                          priority,
+                                          exclusive,
+                                          stream_dependency,
+                                          weight)
+        self._maybe_close_stream(stream)
+        logging.info('stream_id:%s send headers frame. ' % stream.stream_id)
+        self._prepare_for_send(frames)
+
+    def send_request_headers(self, stream_id, template, path, end_stream=False, extra=()):
+        # 按请求模板发送请求头部，模板中不变部分的编码结果在连接内复用
+        # extra: 每个请求各不相同的其他头部（如content-length），与:path一样单独编码
+        stream = self._stream_for_headers(stream_id)
+        header_block = self.encode_request_headers(template, path, extra)
+        self._count_sent_headers(template.size + len(':path') + len(path)
+                                 + sum(len(name) + len(value) for name, value in extra),
+                                 len(header_block))
+        frames = stream.send_header_block(header_block, end_stream)
+        self._maybe_close_stream(stream)
+        logging.info('stream_id:%s send headers frame. ' % stream.stream_id)
+        self._prepare_for_send(frames)
+
+    def _stream_for_headers(self, stream_id):
         if stream_id < 1 or stream_id > self.HIGHEST_ALLOWED_STREAM_ID:
             raise ValueError('the stream id is out of valid range. ')
         if stream_id % 2 != 1:
             raise ValueError('the stream id is not a client id (it should be an odd number). ')
-        stream = self._get_stream_from_id(stream_id)
+        stream = self.streams.get(stream_id)
         if not stream:
             stream = self._create_stream(stream_id)
-        frames = stream.send_headers(headers,self.encoder,
-                                     end_stream,
-                                     padded,
-                                     padded_length,
-                                     priority,
-                                     exclusive,
-                                     stream_dependency,
-                                     weight)
-        logging.info('stream_id:%s send headers frame. ' % stream.stream_id)
-        self._prepare_for_send(frames)
+        return stream
+
+    def encode_request_headers(self, template, path, extra=()):
+        # hpack编码结果取决于编码器的动态表：只要动态表自上次编码后没有变化，
+        # 模板中伪头部和普通头部的编码（此时全部为索引引用）就可以原样复用。
+        # :path及extra每个请求都不同，不进入动态表，见_encode_without_indexing
+        signature = self._header_table_signature()
+        cached = self._header_blocks.get(template)
+        if cached is not None and self._same_header_table(cached[0], signature):
+            block = cached[1] + self._encode_without_indexing(((':path', path),)) + cached[2]
+            if extra:
+                block += self._encode_without_indexing(extra)
+            return block
+        pseudo_block = self.encoder.encode(template.pseudo_headers)
+        path_block = self._encode_without_indexing(((':path', path),))
+        regular_block = self.encoder.encode(self.hpack_policy.mark(template.headers))
+        extra_block = b''
+        if extra:
+            extra_block = self._encode_without_indexing(extra)
+        if self._same_header_table(signature, self._header_table_signature()):
+            # 本次编码没有改变动态表，下次可直接复用
+            if len(self._header_blocks) >= self.MAX_CACHED_HEADER_BLOCKS:
+                self._header_blocks.clear()
+            self._header_blocks[template] = (signature, pseudo_block, regular_block)
+        else:
+            self._header_blocks.pop(template, None)
+        return pseudo_block + path_block + regular_block + extra_block
+
+    def _encode_without_indexing(self, headers):
+        # 以literal without indexing方式编码：不加入动态表，也不挤出模板头部的条目；
+        # never indexed表示敏感数据（中间节点也不得索引），只用于HpackPolicy.never_indexed中的头部
+        # hpack的Encoder.encode只提供incremental indexing和never indexed两种方式，这里直接使用其编码方法
+        encoder = self.encoder
+        never_indexed = self.hpack_policy.never_indexed
+        block = []
+        for name, value in headers:
+            indexbit = INDEX_NEVER if name in never_indexed else INDEX_NONE
+            name = name.encode('utf-8') if isinstance(name, str) else name
+            value = value.encode('utf-8') if isinstance(value, str) else value
+            match = encoder.header_table.search(name, value)
+            if match is None:
+                block.append(encoder._encode_literal(name, value, indexbit, True))
+            elif match[2] is not None:
+                block.append(encoder._encode_indexed(match[0]))
+            else:
+                block.append(encoder._encode_indexed_literal(match[0], value, indexbit, True))
+        return b''.join(block)
+
+    def _header_table_signature(self):
+        # 动态表的签名：新条目总是插入到表头且为新的对象，表头条目不变即说明没有插入过新条目；
+        # 表大小的调整需要在下一个头部块中通知对端，调整期间不使用缓存
+        table = self.encoder.header_table
+        if table.resized:
+            return None
+        entries = table.dynamic_entries
+        return (table.maxsize, len(entries), entries[0] if entries else None)
+
+    @staticmethod
+    def _same_header_table(a, b):
+        return (a is not None and b is not None
+                and a[0] == b[0] and a[1] == b[1] and a[2] is b[2])
+
+    def _count_sent_headers(self, size, encoded_size):
+        self.sent_header_bytes += size
+        self.sent_header_bytes_encoded += encoded_size
+
+    def header_stats(self):
+        # 头部压缩统计，ratio为压缩后与压缩前字节数之比
+        def ratio(encoded, size):
+            return encoded / size if size else None
+        return {
+            'sent_header_bytes': self.sent_header_bytes,
+            'sent_header_bytes_encoded': self.sent_header_bytes_encoded,
+            'sent_ratio': ratio(self.sent_header_bytes_encoded, self.sent_header_bytes),
+            'received_header_bytes': self.received_header_bytes,
+            'received_header_bytes_encoded': self.received_header_bytes_encoded,
+            'received_ratio': ratio(self.received_header_bytes_encoded, self.received_header_bytes),
+        }
 
     # 接受到settings帧，解析它并进行配置更新
     def _receive_settings_frame(self, frame:SettingsFrame):
         # 根据接收到的是否为ACK帧进行判断处理
         assert frame.stream_id == 0, 'settings frame stream id should be 0. '
-        if 'ACK' in frame.flags:
+        if frame.flag_bits & FLAG_ACK:
             logging.info('stream_id:%s receive settings ACK frame. ' % frame.stream_id)
             pass
         else:
             logging.info('stream_id:%s receive settings frame.(%s) ' % (frame.stream_id,frame.settings))
+            initial_window_size = frame.settings.get(SettingsFrame.INITIAL_WINDOW_SIZE)
+            if initial_window_size is not None and initial_window_size > self.MAX_FLOW_CONTROL_WINDOW:
+                raise ValueError('flow control error(0x%x): initial window size %s is too large. '
+                                 % (self.FLOW_CONTROL_ERROR, initial_window_size))
+            max_frame_size = frame.settings.get(SettingsFrame.MAX_FRAME_SIZE)
+            if max_frame_size is not None and not (self.MIN_MAX_FRAME_SIZE <= max_frame_size
+                                                   <= self.MAX_MAX_FRAME_SIZE):
+                raise ValueError('protocol error(0x%x): invalid max frame size %s. '
+                                 % (self.PROTOCOL_ERROR, max_frame_size))
+            old_window_size = self.remote_settings.initial_window_size
             for setting, value in frame.settings.items():
                 if setting in self.remote_settings:
                     self.remote_settings[setting] = value
-            ack_frame = SettingsFrame(frame.stream_id)
-            self._prepare_for_send([ack_frame])
-            logging.info('stream_id:%s send settings ACK frame. ' % ack_frame.stream_id)
+            self.remote_settings_received = True
+            events = []
+            if initial_window_size is not None and initial_window_size != old_window_size:
+                events.extend(self._apply_initial_window_delta(initial_window_size - old_window_size))
+            if max_frame_size is not None:
+                for stream in self.streams.values():
+                    stream.max_outbound_frame_size = max_frame_size
+            if (SettingsFrame.HEADER_TABLE_SIZE in frame.settings
+                    or SettingsFrame.MAX_HEADER_LIST_SIZE in frame.settings):
+                # 按对端的新设置调整编码器，动态表大小的变化会在下一个头部块中通知对端
+                self.__set_encoder()
+            self._data_to_send.append(SETTINGS_ACK)
+            logging.info('stream_id:%s send settings ACK frame. ' % frame.stream_id)
+            # 对端配置（如MAX_CONCURRENT_STREAMS）可能变化，通知上层
+            event = SettingsReceived()
+            event.stream_id = frame.stream_id
+            event.settings = frame.settings
+            events.insert(0, event)
+            # 窗口增大后发送排队的数据
+            events.extend(self._send_pending_data())
+            return events
         return []
+
+    def _apply_initial_window_delta(self, delta):
+        # INITIAL_WINDOW_SIZE变化时，所有已开启流的发送窗口按差值调整（可能变为负数），连接级窗口不受影响
+        events = []
+        for stream in self.streams.values():
+            if stream.outbound_window_size + delta > self.MAX_FLOW_CONTROL_WINDOW:
+                raise ValueError('flow control error(0x%x): window of stream %s exceeds 2**31 - 1. '
+                                 % (self.FLOW_CONTROL_ERROR, stream.stream_id))
+            stream.outbound_window_size += delta
+            if delta > 0:
+                events.append(WindowUpdated(stream.stream_id, delta))
+        return events
     # def receive_data(self, data):
     #     # 总的数据接收入口
     #     pass
     def _receive_headers_frame(self, frame):
 
-        stream = self._get_stream_from_id(frame.stream_id)
+        stream = self.streams.get(frame.stream_id)
         if not stream:
-            stream = self._create_stream(frame.stream_id)
+            # 已关闭或从未开启的流，头部块仍需解码以保持hpack动态表同步
+            self.decoder.decode(frame.data)
+            logging.info('stream_id:%s ignore headers frame on closed stream. ' % frame.stream_id)
+            return []
         event = stream.receive_headers(frame, self.decoder)
+        self.received_header_bytes += sum(len(name) + len(value) for name, value in event.headers)
+        self.received_header_bytes_encoded += len(frame.data)
         logging.info('stream_id:%s receive headers frame. ' % stream.stream_id)
-        return [event]
+        return [event] + self._maybe_close_stream(stream)
 
     def _receive_continuation_frame(self, frame):
         logging.info('stream_id:%s receive continuation frame. ' % frame.stream_id)
 
     def _receive_data_frame(self, frame:DataFrame):
 
-        stream = self._get_stream_from_id(frame.stream_id)
+        stream = self.streams.get(frame.stream_id)
         # print(frame.body_len,self.inbound_window_manager.current_window_size)
         self.inbound_window_manager.current_window_reduce(frame.body_len)
         if not stream:
-            stream = self._create_stream(frame.stream_id)
+            # 已关闭的流上的数据直接丢弃，但需要归还连接级窗口
+            logging.info('stream_id:%s ignore data frame on closed stream. ' % frame.stream_id)
+            self.ack_data_received(frame.body_len)
+            return []
         event = stream.receive_data(frame)
+        closed = self._maybe_close_stream(stream)
 
         logging.info('stream_id:%s receive data frame(end stream:%s). ' % (stream.stream_id, event.end_stream))
         # if event.end_stream:
         #     end_stream_frame = DataFrame(event.stream_id)
         #     end_stream_frame.add_flag('END_STREAM')
         #     self._prepare_for_send([end_stream_frame])
-        return [event]
+        return [event] + closed
 
     def ack_data_received(self, received_size, stream_id=None):
         # 表示数据已接收，通知流窗口管理器
-        # print(self.inbound_window_manager.current_window_size)
-        frames = []
+        # WINDOW_UPDATE帧直接使用缓存的序列化结果，不创建帧对象
         increment = self.inbound_window_manager.process_bytes(received_size)
-        # print('conn increment:%s,current size:%s'%(increment,self.inbound_window_manager.current_window_size))
         if increment:
-            wf = WindowUpdateFrame(0,increment)
+            self._data_to_send.append(window_update_bytes(0, increment))
             logging.info('stream_id:%s send window update(%s)'%(0,increment))
-            frames.append(wf)
 
         if stream_id:
-            stream = self._get_stream_from_id(stream_id)
-            if stream:
-                wf = stream.ack_data_received(received_size)
-                if wf:
-                    frames.append(wf)
-                    logging.info('stream_id:%s send window update(%s)' % (stream.stream_id, wf.increment))
-
-        self._prepare_for_send(frames)
+            self.ack_stream_data_received(received_size, stream_id)
+
+    def ack_stream_data_received(self, received_size, stream_id):
+        # 只恢复流级窗口：流式读取响应体时，连接级窗口在收到数据时即归还，
+        # 流级窗口在使用者读取数据后才归还，使单个流缓存的数据不超过其窗口大小
+        # 已关闭的流无需再更新窗口
+        stream = self.streams.get(stream_id)
+        if stream:
+            increment = stream.ack_data_received(received_size)
+            if increment:
+                self._data_to_send.append(window_update_bytes(stream_id, increment))
+                logging.info('stream_id:%s send window update(%s)' % (stream.stream_id, increment))
 
     def _receive_rst_stream_frame(self, frame):
 
-        stream = self._get_stream_from_id(frame.stream_id)
+        stream = self.streams.get(frame.stream_id)
         if not stream:
-            stream = self._create_stream(frame.stream_id)
+            if frame.stream_id > self.highest_stream_id:
+                raise ValueError('IDLE stream receive rst_stream frame. ')
+            logging.info('stream_id:%s ignore reset stream on closed stream. ' % frame.stream_id)
+            return []
         if stream.status == StreamState.IDLE:
             raise ValueError('IDLE stream receive rst_stream frame. ')
         event = stream.receive_rst_stream(frame)
         logging.info('stream_id:%s receive reset stream. ' % stream.stream_id)
-        return [event]
+        return [event] + self._maybe_close_stream(stream)
 
     def receive_goaway_frame(self, frame:GoAwayFrame):
 
+        # 对端不会再接受新的流；id大于last_stream_id的流对端未处理，直接关闭，
+        # 不大于last_stream_id的流仍会正常完成
         event = GoawayReceived()
         event.stream_id = frame.stream_id
+        event.last_stream_id = frame.last_stream_id
         event.error_code = frame.error_code
         event.error_message = frame.error_message
         self.status = ConnectionState.CLOSED
-        logging.info('stream_id:%s receive goaway frame. ' % frame.stream_id)
-        return [event]
+        self.goaway_last_stream_id = frame.last_stream_id
+        logging.info('stream_id:%s receive goaway frame(last_stream_id:%s). ' % (
+            frame.stream_id, frame.last_stream_id))
+        events = [event]
+        for stream in [s for s in self.streams.values()
+                       if s.stream_id > frame.last_stream_id]:
+            stream.status = StreamState.CLOSED
+            events.extend(self._maybe_close_stream(stream))
+        return events
 
     def receive_window_update_frame(self, frame:WindowUpdateFrame):
-        # 暂时未实现流控完整性
+        # 发送窗口的更新：stream_id为0时为连接级窗口，否则为对应流的窗口
+        # 连接级的错误抛出ValueError，流级的错误只重置该流
         increment = frame.increment
-        if self.outbound_flow_control_window + increment > 2**31 - 1:
-            raise ValueError('outbound window should not more than 2**31 - 1.')
-        self.outbound_flow_control_window += increment
+        if frame.stream_id == 0:
+            if increment == 0:
+                raise ValueError('protocol error(0x%x): window update increment is 0. '
+                                 % self.PROTOCOL_ERROR)
+            if self.outbound_flow_control_window + increment > self.MAX_FLOW_CONTROL_WINDOW:
+                raise ValueError('flow control error(0x%x): outbound window exceeds 2**31 - 1. '
+                                 % self.FLOW_CONTROL_ERROR)
+            self.outbound_flow_control_window += increment
+        else:
+            stream = self.streams.get(frame.stream_id)
+            if stream is None:
+                # 已关闭的流无需更新窗口
+                return []
+            if increment == 0:
+                return self._reset_stream_for_error(stream, self.PROTOCOL_ERROR)
+            if stream.outbound_window_size + increment > self.MAX_FLOW_CONTROL_WINDOW:
+                return self._reset_stream_for_error(stream, self.FLOW_CONTROL_ERROR)
+            stream.outbound_window_size += increment
         logging.info('stream_id:%s receive window update frame(%d). ' % (frame.stream_id, increment))
-        return []
+        # 发送因窗口不足而排队的数据
+        return [WindowUpdated(frame.stream_id, increment)] + self._send_pending_data()
+
+    def _reset_stream_for_error(self, stream, error_code):
+        # 对端在该流上违反协议：发送RST_STREAM并关闭该流，返回带error_code的StreamClosed事件
+        logging.info('stream_id:%s reset stream for error(0x%x). ' % (stream.stream_id, error_code))
+        self._prepare_for_send([RstStreamFrame(stream.stream_id, error_code)])
+        stream.status = StreamState.CLOSED
+        events = self._maybe_close_stream(stream)
+        for event in events:
+            event.error_code = error_code
+        return events
 
     def _receive_ping_frame(self, frame:PingFrame):
         events = []
-        if 'ACK' in frame.flags:
+        if frame.flag_bits & FLAG_ACK:
             e = PingReceived()
             e.ACK = True
             e.stream_id = frame.stream_id
@@ -266,93 +546,175 @@ class H2Connection(object):
                                                                          e.ACK))
             events.append(e)
         else:
-            p_ack = PingFrame(0, frame.data, ('ACK',))
             e = PingReceived()
             e.stream_id = frame.stream_id
             e.data = frame.data
             logging.info('stream_id:%s send ping frame(ACK:%s). ' % (frame.stream_id,
                                                                          e.ACK))
             events.append(e)
-            self._prepare_for_send([p_ack])
+            self._data_to_send.append(ping_ack_bytes(frame.data))
 
         return events
 
-    def _get_stream_from_id(self, stream_id) -> H2Stream:
-
-        stream = self.streams.get(stream_id, None)
-        return stream
-
-    # 注意：stream_id的合法性还没有进行验证，
-    # 流id的管理功能还未实现，
+    # 默认作为客户端创建流，流id必须大于已开启过的所有流id
     def _create_stream(self, stream_id):
         # 默认作为客户端创建流，且不接受推送
         if stream_id < 0 or stream_id > 2**31 - 1:
             raise ValueError('stream id is out of range.')
-        if stream_id < self.max_current_stream_id:
+        if stream_id <= self.highest_stream_id:
             raise ValueError('new stream id must be higher than %s'
-                             % self.max_current_stream_id)
+                             % self.highest_stream_id)
         if stream_id % 2 != 1:
             raise ValueError('Invalid client stream id. ')
-        for sid, stream in self.streams.items():
-            if stream.status == StreamState.CLOSED:
-                self.streams.pop(sid)
         stream = H2Stream(stream_id,
-                          self.outbound_flow_control_window,
+                          self.remote_settings.initial_window_size,
                           self.inbound_flow_control_window,
                           self.remote_settings.max_frame_size,
                           self.local_settings.max_frame_size)
         self.streams[stream_id] = stream
+        self.highest_stream_id = stream_id
+        self.next_stream_id = stream_id + 2
         return stream
 
+    def _maybe_close_stream(self, stream):
+        # 流进入CLOSED状态后立即从存活索引中移除，之后该id上的帧按已关闭的流处理
+        # 返回包含StreamClosed事件的列表，流未关闭时返回空列表
+        if stream.status != StreamState.CLOSED:
+            return []
+        if self.streams.pop(stream.stream_id, None) is None:
+            return []
+        # 流已关闭，丢弃尚未发送的请求体
+        self._pending_data.pop(stream.stream_id, None)
+        return [StreamClosed(stream.stream_id)]
+
     def get_next_available_stream(self):
-        # 返回下一个可开启的id
-        for sid, stream in self.streams.items():
-            if stream.status == StreamState.CLOSED:
-                self.streams.pop(sid)
-        if self.streams:
-            current_highest_id = max(self.streams.keys())
-        else:
-            current_highest_id = 0
-        if current_highest_id % 2 == 1:
-            available_id = current_highest_id + 2
-        else:
-            available_id = current_highest_id + 1
-        if available_id > (2**31 - 1):
+        # 返回下一个可开启的id，id耗尽时返回None
+        if self.next_stream_id > self.HIGHEST_ALLOWED_STREAM_ID:
             return None
-        return available_id
+        return self.next_stream_id
 
     @property
     def max_current_stream_id(self):
-        # 当前已打开的最大流id
-        # 更新并返回最大id
-        for sid, stream in self.streams.items():
-            if stream.status == StreamState.CLOSED:
-                self.streams.pop(sid)
-        return max(self.streams.keys(), default=0)
+        # 已开启过的最大流id
+        return self.highest_stream_id
+
+    @property
+    def open_stream_count(self):
+        # 当前存活的流数量
+        return len(self.streams)
+
+    @property
+    def available_stream_slots(self):
+        # 按对端MAX_CONCURRENT_STREAMS计算，当前还可以开启的流数量
+        # 收到对端settings之前并不知道其实际限制，只允许开启一个流，其余请求等待settings到达
+        if not self.remote_settings_received:
+            return max(1 - len(self.streams), 0)
+        return max(self.remote_settings.max_concurrent_streams -
+                   len(self.streams), 0)
 
     def _prepare_for_send(self, frames):
         for frame in frames:
-            self._data_to_send += frame.serialize()
+            header, body = frame.serialize_parts()
+            self._data_to_send.append(header)
+            if body:
+                self._data_to_send.append(body)
 
     def data_to_send(self):
         # 返回需要发送的数据，并清空缓存区
-        data = self._data_to_send
-        self._data_to_send = b''
+        data = b''.join(self._data_to_send)
+        self._data_to_send = []
         return data
 
+    def buffers_to_send(self):
+        # 返回待发送的缓冲区列表（不做拼接），并清空缓存区
+        buffers = self._data_to_send
+        self._data_to_send = []
+        return buffers
+
     # 根据配置设置hpack编码参数
     def __set_encoder(self):
         self.encoder.max_header_list_size = self.remote_settings.max_header_list_size
-        self.encoder.header_table_size = self.remote_settings.header_table_size
+        table_size = min(self.remote_settings.header_table_size,
+                         self.hpack_policy.max_encoder_table_size)
+        if table_size != self.encoder.header_table_size:
+            self.encoder.header_table_size = table_size
 
     # 根据配置设置hpack解码参数
     def __set_decoder(self):
         self.decoder.max_header_list_size = self.local_settings.max_header_list_size
-        self.decoder.header_table_size = self.local_settings.header_table_size
+        # 对端编码器的动态表初始为4096字节，通过头部块中的大小更新指令扩大，
+        # 解码器只限制其上限，不能直接修改当前大小，否则双方的动态表会不一致
+        self.decoder.max_allowed_table_size = self.local_settings.header_table_size
+
+    def send_data(self, stream_id, data, end_stream=False):
+        # 发送请求体数据：按对端的MAX_FRAME_SIZE分帧，同时受连接级和流级发送窗口限制，
+        # 超出窗口的部分排队，收到WINDOW_UPDATE后继续发送；返回因此关闭的流的StreamClosed事件
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.status not in (StreamState.OPEN, StreamState.HALF_CLOSED_REMOTE):
+            raise ValueError('stream %s is not open for sending data. ' % stream_id)
+        pending = self._pending_data.get(stream_id)
+        if pending is None:
+            pending = self._pending_data[stream_id] = collections.deque()
+        elif pending[-1][1]:
+            raise ValueError('stream %s has already ended. ' % stream_id)
+        pending.append([memoryview(data).cast('B') if len(data) else b'', end_stream])
+        return self._send_stream_data(stream)[1]
+
+    def pending_data_size(self, stream_id):
+        # 该流因窗口不足尚未发送的数据量
+        pending = self._pending_data.get(stream_id)
+        if not pending:
+            return 0
+        return sum(len(data) for data, _ in pending)
+
+    def _send_pending_data(self):
+        # 发送调度：窗口增大后按轮转顺序为被阻塞的流每次发送一帧，直到窗口耗尽或数据发完；
+        # 发送过的流移到队尾，排在前面的流不会独占连接级窗口
+        events = []
+        while self._pending_data:
+            progress = False
+            for stream_id in list(self._pending_data):
+                stream = self.streams.get(stream_id)
+                if stream is None:
+                    self._pending_data.pop(stream_id, None)
+                    continue
+                sent, closed = self._send_stream_data(stream, max_frames=1)
+                if sent:
+                    progress = True
+                    pending = self._pending_data.pop(stream_id, None)
+                    if pending is not None:
+                        self._pending_data[stream_id] = pending
+                events.extend(closed)
+            if not progress:
+                break
+        return events
 
-    def send_data(self, stream_id, data):
-        # 封帧
-        pass
+    def _send_stream_data(self, stream, max_frames=None):
+        # 在窗口允许的范围内发送该流排队的数据，最多max_frames帧，返回(发送的帧数, StreamClosed事件)
+        pending = self._pending_data[stream.stream_id]
+        max_frame_size = self.remote_settings.max_frame_size
+        frames = []
+        while pending and (max_frames is None or len(frames) < max_frames):
+            item = pending[0]
+            data, end_stream = item
+            size = min(len(data), max_frame_size,
+                       self.outbound_flow_control_window, stream.outbound_window_size)
+            if size <= 0 and len(data):
+                break
+            rest = data[size:]
+            frames.append(stream.send_data(data[:size], end_stream and not len(rest)))
+            self.outbound_flow_control_window -= size
+            if len(rest):
+                item[0] = rest
+            else:
+                pending.popleft()
+        if not pending:
+            del self._pending_data[stream.stream_id]
+        if not frames:
+            return 0, []
+        logging.info('stream_id:%s send %s data frame(s). ' % (stream.stream_id, len(frames)))
+        self._prepare_for_send(frames)
+        return len(frames), self._maybe_close_stream(stream)
 
     def receive_data(self, data):
         events = []
@@ -374,10 +736,11 @@ class H2Connection(object):
     def send_rst_stream(self,stream_id, error_code=0):
 
         rf = RstStreamFrame(stream_id, error_code)
-        stream = self._get_stream_from_id(stream_id)
+        stream = self.streams.get(stream_id)
         if not stream:
-            raise ValueError('there is not stream_id_%s to send rst_frame.')
+            raise ValueError('there is not stream_id_%s to send rst_frame.' % stream_id)
         stream.status = StreamState.CLOSED
+        self._maybe_close_stream(stream)
         logging.info('stream_id:%s send reset stream frame. ' % rf.stream_id)
         self._prepare_for_send([rf])
 
@@ -388,8 +751,7 @@ class H2Connection(object):
         self._prepare_for_send([pf])
 
     def send_window_update(self, increment, stream_id=0):
-        wf = WindowUpdateFrame(stream_id, increment)
-        self._prepare_for_send([wf])
+        self._data_to_send.append(window_update_bytes(stream_id, increment))
 
 
 if __name__ == '__main__':
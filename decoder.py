@@ -0,0 +1,68 @@
+import zlib
+
+# 响应体的增量解压：随DATA帧到达逐块解压，无需等待完整响应体，也不需要同时保留压缩和解压后的两份数据
+
+
+class ContentDecoder(object):
+    # encoding: content-encoding的值（gzip、deflate，其他值视为不压缩）
+    # max_size: 解压后数据的最大长度，超出时抛出ValueError，用于防范解压炸弹；None表示不限制
+    def __init__(self, encoding=None, max_size=None):
+        super(ContentDecoder, self).__init__()
+        self.encoding = (encoding or '').strip().lower()
+        self.max_size = max_size
+        # 已输出的解压后长度
+        self.size = 0
+        self._first = True
+        if self.encoding == 'gzip':
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self._obj = zlib.decompressobj()
+        else:
+            self._obj = None
+
+    @property
+    def passthrough(self):
+        # 不需要解压
+        return self._obj is None
+
+    def decompress(self, data):
+        # 解压一块数据，返回本次得到的解压后数据
+        if self._obj is None:
+            result = bytes(data)
+        else:
+            try:
+                result = self._decompress(data)
+            except zlib.error as e:
+                if not (self._first and self.encoding == 'deflate'):
+                    raise ValueError('decompress %s content failed: %s' % (self.encoding, e))
+                # 部分服务器的deflate响应不带zlib头部，按原始deflate数据重新解压
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+                try:
+                    result = self._decompress(data)
+                except zlib.error as e:
+                    raise ValueError('decompress %s content failed: %s' % (self.encoding, e))
+        self._first = False
+        self._count(len(result))
+        return result
+
+    def _decompress(self, data):
+        if self.max_size is None:
+            return self._obj.decompress(data)
+        # 最多只解压出超限所需的长度，避免炸弹数据在内存中完全展开
+        return self._obj.decompress(data, self.max_size - self.size + 1)
+
+    def flush(self):
+        # 响应体结束，返回剩余的解压后数据
+        if self._obj is None:
+            return b''
+        try:
+            result = self._obj.flush()
+        except zlib.error as e:
+            raise ValueError('decompress %s content failed: %s' % (self.encoding, e))
+        self._count(len(result))
+        return result
+
+    def _count(self, length):
+        self.size += length
+        if self.max_size is not None and self.size > self.max_size:
+            raise ValueError('decompressed content is larger than %s bytes. ' % self.max_size)
@@ -18,18 +18,56 @@ class HeadersReceived(Event):
 
 class DataReceived(Event):
 
-
-    def __init__(self):
-        self.data = None
+    # payload以接收缓冲区的视图（memoryview）保存，只有在读取data时才复制成bytes，
+    # 若只需写入响应体可使用write_to直接复制进目标，丢弃的响应体则完全不发生复制
+    def __init__(self, view=None):
+        self._view = view
+        self._data = None
+        # payload长度，无需读取data即可获得
+        self.data_length = len(view) if view is not None else 0
         self.end_stream = False
         # 标记已消耗的窗口
         self.flow_window_length = None
 
+    @property
+    def data(self):
+        if self._data is None and self._view is not None:
+            self._data = bytes(self._view)
+            self._view = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._view = None
+        self.data_length = len(value) if value is not None else 0
+
+    @property
+    def payload(self):
+        # 不复制地访问payload（可能是接收缓冲区的视图），只在处理该事件期间有效
+        return self._view if self._data is None else self._data
+
+    def write_to(self, sink):
+        # 将payload直接复制进sink（bytearray或具有write方法的文件对象），返回写入长度
+        payload = self.payload
+        if payload:
+            if isinstance(sink, bytearray):
+                sink.extend(payload)
+            else:
+                sink.write(payload)
+        return self.data_length
+
+    def discard(self):
+        # 丢弃payload，释放对接收缓冲区的引用
+        self._view = None
+        self._data = None
+
     def __repr__(self):
+        payload = self._view if self._data is None else self._data
         return '<DataReceived stream_id:%s, end_stream:%s, data:%s>' % (
             self.stream_id,
             self.end_stream,
-            self.data[0:50]+b'...' if self.data else None
+            bytes(payload[0:50])+b'...' if payload else None
         )
 
 
@@ -46,16 +84,43 @@ class SettingsReceived(Event):
         )
 
 
+class StreamClosed(Event):
+
+    # 流进入CLOSED状态（正常结束或被重置），可用于释放并发流名额
+    # error_code: 本端因对端违反协议（如流控错误）而重置该流时的错误码，正常关闭时为None
+    def __init__(self, stream_id=None, error_code=None):
+        self.stream_id = stream_id
+        self.error_code = error_code
+
+    def __repr__(self):
+        return '<StreamClosed stream_id:%s, error_code:%s>' % (self.stream_id, self.error_code)
+
+
+class WindowUpdated(Event):
+
+    # 发送窗口增大（收到WINDOW_UPDATE，或对端调大了INITIAL_WINDOW_SIZE），stream_id为0时为连接级窗口
+    # 排队中的数据已按新窗口尽量发出，上层可据此唤醒等待发送的请求体
+    def __init__(self, stream_id=None, delta=None):
+        self.stream_id = stream_id
+        self.delta = delta
+
+    def __repr__(self):
+        return '<WindowUpdated stream_id:%s, delta:%s>' % (self.stream_id, self.delta)
+
+
 class GoawayReceived(Event):
 
     # 整个连接的结束
+    # last_stream_id: 对端已处理（或可能处理）的最大流id，更大的流可以安全地重试
     def __init__(self):
+        self.last_stream_id = None
         self.error_code = None
         self.error_message = None
 
     def __repr__(self):
-        return '<GoawayReceived stream_id:%s, error_code:%s, error_message:%s>' % (
+        return '<GoawayReceived stream_id:%s, last_stream_id:%s, error_code:%s, error_message:%s>' % (
             self.stream_id,
+            self.last_stream_id,
             self.error_code,
             self.error_message
         )
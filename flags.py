@@ -19,6 +19,13 @@ DataFlags.PADDED = 0x08
 
 Flag = namedtuple("Flag", ["name", "bit"])
 
+# 帧内部以整数位掩码保存flags，以下常量用于热路径上的位运算判断
+FLAG_ACK = 0x01
+FLAG_END_STREAM = 0x01
+FLAG_END_HEADERS = 0x04
+FLAG_PADDED = 0x08
+FLAG_PRIORITY = 0x20
+
 
 class Flags(set):
     """
@@ -58,6 +65,40 @@ class Flags(set):
     def __repr__(self):
         return ' '.join(self._flags)
 
+class FlagsView(object):
+    """
+    Frame.flags的兼容视图：对外仍表现为flag名字符串的集合，
+    实际读写的是帧对象上的整数位掩码flag_bits。
+    """
+    __slots__ = ('_frame',)
+
+    def __init__(self, frame):
+        self._frame = frame
+
+    def __contains__(self, x):
+        bit = self._frame._flag_bits.get(x)
+        return bit is not None and bool(self._frame.flag_bits & bit)
+
+    def __iter__(self):
+        bits = self._frame.flag_bits
+        return iter([name for name, bit in self._frame.defined_flags
+                     if bits & bit])
+
+    def __len__(self):
+        return len(list(self.__iter__()))
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def add(self, value):
+        self._frame.add_flag(value)
+
+    def discard(self, value):
+        self._frame.discard_flag(value)
+
+    def __repr__(self):
+        return ' '.join(self)
+
 if __name__ == '__main__':
     defined_flags = [
         Flag('END_STREAM', 0x01),
@@ -6,6 +6,7 @@ try:
 except:
     from flags import *
 import struct
+import functools
 import logging, logconfig
 
 
@@ -31,43 +32,59 @@ _STRUCT_B = struct.Struct(">B")
 
 
 class Frame(object):
-
+    # flags以整数位掩码flag_bits保存，frame.flags仅作为兼容旧接口的字符串视图
+    __slots__ = ('stream_id', 'body_len', 'flag_bits')
 
     type = None
     defined_flags = []
+    # {flag名: 比特位}，以及该帧类型支持的全部比特位，由子类定义时自动生成
+    _flag_bits = {}
+    _flags_mask = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._flag_bits = {flag.name: flag.bit for flag in cls.defined_flags}
+        cls._flags_mask = 0
+        for flag in cls.defined_flags:
+            cls._flags_mask |= flag.bit
+
     # flags为包含有标志字符串的元组
     def __init__(self,stream_id,flags=()):
         self.stream_id = stream_id
         self.body_len = 0
-        self.flags = Flags(self.defined_flags)
+        self.flag_bits = 0
         # 添加标志位初始化
         for flag in flags:
-            self.flags.add(flag)
+            self.add_flag(flag)
 
     def __repr__(self):
         return type(self).__name__
 
+    @property
+    def flags(self):
+        return FlagsView(self)
+
     # 将相关数据按照帧首部格式进行填充，添加payload数据负载后返回已封装完毕的帧
     def serialize(self):
+        return b''.join(self.serialize_parts())
+
+    # 分别返回帧首部和payload，供分散写（scatter-gather）发送，避免拼接复制
+    def serialize_parts(self):
         body = self.serialize_body()
         self.body_len = len(body)
-        # 逐一检查flag标志位
-        flags = 0
-        for flag, flag_bit in self.defined_flags:
-            if flag in self.flags:
-                flags |= flag_bit
+        return self.serialize_header(), body
 
+    # 根据body_len和flags封装9字节的帧首部
+    def serialize_header(self):
         # 封装头部
-        header = _STRUCT_HBBBL.pack(
+        return _STRUCT_HBBBL.pack(
             (self.body_len >> 8) & 0xFFFF,  # 高位24比特
             self.body_len & 0xFF, # 低8位比特
             self.type,
-            flags,
+            self.flag_bits,
             self.stream_id & 0x7FFFFFFF  # Stream ID  31比特.
         )
 
-        return header + body
-
 
     # 返回payload序列化后的数据
     # 此函数提供接口，需在具体帧类型内部进行各自的方法实现覆盖
@@ -75,9 +92,10 @@ class Frame(object):
         raise NotImplementedError
 
     # 传入前帧首部（数据前9字节）进行解析，返回指定类型的Frame(flags已识别）和长度
+    # offset用于直接从接收缓冲区的指定位置解析，无需先切片复制出首部
     @staticmethod
-    def parse_frame_header(header):
-        fields = _STRUCT_HBBBL.unpack(header)
+    def parse_frame_header(header, offset=0):
+        fields = _STRUCT_HBBBL.unpack_from(header, offset)
         #payload数据长度
         length = (fields[0] << 8) + fields[1]
         #帧类型
@@ -88,34 +106,44 @@ class Frame(object):
         R = fields[4] & 0x80000000
         # 流id
         stream_id = fields[4] & 0x7FFFFFFF
-        try:
-            frame = FRAMES[type](stream_id)
-        except KeyError:
-            print(header)
-            raise('unknow type frame.')
+        if type not in FRAMES:
+            raise ValueError('unknow type frame: %s.' % type)
+        frame = Frame.from_fields(type, flags, stream_id, length)
+        return (frame,length)
+
+    # 根据已解析的首部字段创建对应类型的Frame（flags已识别，payload待解析）
+    @staticmethod
+    def from_fields(type, flags, stream_id, length):
+        frame = FRAMES[type](stream_id)
         frame.body_len = length
         frame._set_flags(flags)
-        return (frame,length)
+        return frame
 
     # 对payload解析然后填充，需在各自类型帧内部实现
+    # data可能为接收缓冲区的memoryview切片，需要长期保存的小块数据应转为bytes
     def parse_body(self, data):
 
         raise NotImplementedError
 
-    # 根据flags的原始数据字段，格式化成Flags
+    # 根据flags的原始数据字段设置位掩码，忽略该帧类型未定义的比特位
     def _set_flags(self,flags_bytes):
-        for flag, bit in self.defined_flags:
-            if flags_bytes & bit:
-                self.flags.add(flag)
-        return self.flags
+        self.flag_bits = flags_bytes & self._flags_mask
+        return self.flag_bits
 
     # 添加flag
     def add_flag(self,flag_string):
-        self.flags.add(flag_string)
+        try:
+            self.flag_bits |= self._flag_bits[flag_string]
+        except KeyError:
+            raise ValueError(
+                "Unexpected flag: {}. Valid flags are: {}".format(
+                    flag_string, set(self._flag_bits)
+                )
+            )
 
     # 移除flag
     def discard_flag(self,flag_string):
-        self.flags.discard(flag_string)
+        self.flag_bits &= ~self._flag_bits.get(flag_string, 0)
 
     def show_itself(self):
         N = 'NULL'
@@ -128,6 +156,7 @@ class Frame(object):
         print(info)
 
 class DataFrame(Frame):
+    __slots__ = ('data', 'padded_length')
 
     type = 0x00
     defined_flags = [
@@ -147,28 +176,30 @@ class DataFrame(Frame):
 
     def serialize_body(self):
         data = self.data
-        padded_length_data = b''
-        padded_data = b''
-        if 'PADDED' in self.flags:
-            padded_length_data = _STRUCT_B.pack(self.padded_length)
-            padded_data = b'\0' * self.padded_length
+        if not self.flag_bits & FLAG_PADDED:
+            # 无填充时直接返回原始数据，避免复制大块payload
+            return data
+        padded_length_data = _STRUCT_B.pack(self.padded_length)
+        padded_data = b'\0' * self.padded_length
         return b''.join([padded_length_data,
                          data,
                          padded_data])
 
     def parse_body(self, data):
+        # data为memoryview时直接保存切片视图，payload不做复制
         self.body_len = len(data)
-        if 'PADDED' in self.flags:
-            self.padded_length = _STRUCT_B.unpack(data[0])[0]
+        if self.flag_bits & FLAG_PADDED:
+            self.padded_length = data[0]
             if (len(data) - 1) < self.padded_length:
-                raise ValueError('Invalid headers data.')
+                raise ValueError('Invalid data frame.')
+            self.data = data[1:len(data) - self.padded_length]
         else:
             self.padded_length = 0
-
-        self.data = data[1:-self.padded_length] if self.padded_length else data
+            self.data = data
 
 
 class HeadersFrame(Frame):
+    __slots__ = ('data', 'padded_length', 'exclusive', 'stream_dependency', 'weight')
 
 
     type = 0x01
@@ -206,10 +237,10 @@ class HeadersFrame(Frame):
         padded_data = b''
         dependency_data = b''
         weight_data = b''
-        if 'PADDED' in self.flags:
+        if self.flag_bits & FLAG_PADDED:
             padded_length_data = _STRUCT_B.pack(self.padded_length)
             padded_data = b'\0' * self.padded_length
-        if 'PRIORITY' in self.flags:
+        if self.flag_bits & FLAG_PRIORITY:
             dependency_data = _STRUCT_L.pack((self.stream_dependency & 0x7FFFFFFF) |
                                              (0xFFFFFFFF if self.exclusive else 1))
             weight_data = _STRUCT_B.pack(self.weight)
@@ -229,14 +260,15 @@ class HeadersFrame(Frame):
         # 注意body_len指的是整个payload（包含了填充以及优先信息）的长度
         # data指的是头部数据块的长度（仅头部主体数据）
         self.body_len = len(data)
-        if 'PADDED' in self.flags:
-            self.padded_length = _STRUCT_B.unpack(data[0])[0]
+        if self.flag_bits & FLAG_PADDED:
+            self.padded_length = data[0]
+            if (len(data) - 1) < self.padded_length:
+                raise ValueError('Invalid headers data.')
+            self.data = data[1:len(data) - self.padded_length]
         else:
             self.padded_length = 0
-        if (len(data) - 1) < self.padded_length:
-            raise ValueError('Invalid headers data.')
-        self.data = data[1:-self.padded_length] if self.padded_length else data
-        if 'PRIORITY' in self.flags:
+            self.data = data
+        if self.flag_bits & FLAG_PRIORITY:
             fields = _STRUCT_LB.unpack(self.data[0:5])
             self.exclusive = fields[0] >> 31
             self.stream_dependency = fields[0] & 0x7FFFFFFF
@@ -245,9 +277,10 @@ class HeadersFrame(Frame):
 
 
 class PriorityFrame(Frame):
-    pass
+    __slots__ = ()
 
 class RstStreamFrame(Frame):
+    __slots__ = ('error_code',)
     # 标识流的结束，可选参数错误码
 
     type = 0x03
@@ -266,6 +299,7 @@ class RstStreamFrame(Frame):
         self.error_code = _STRUCT_L.unpack(data[0:4])[0]
 
 class SettingsFrame(Frame):
+    __slots__ = ('settings',)
     # 帧类型为0x04，表示SETTINGS帧
     type = 0x04
     #该帧支持的标志位
@@ -312,9 +346,10 @@ class SettingsFrame(Frame):
             self.settings[identifier] = value
 
 class PushPromiseFrame(Frame):
-    pass
+    __slots__ = ()
 
 class PingFrame(Frame):
+    __slots__ = ('opaque_data', 'data')
     # 用于测试连接性和可用性
     type = 0x06
     defined_flags = [Flag('ACK', 0x01)]
@@ -327,15 +362,16 @@ class PingFrame(Frame):
 
         if len(self.opaque_data) > 8:
             raise ValueError('opaque data length should not be more than 8 bytes.')
-        data = b'\0'* (8 - len(self.opaque_data))
+        data = self.opaque_data + b'\0'* (8 - len(self.opaque_data))
         return data
 
     def parse_body(self, data):
 
-        self.data = data
+        self.data = bytes(data)
         self.body_len = len(self.data)
 
 class GoAwayFrame(Frame):
+    __slots__ = ('last_stream_id', 'error_code', 'error_message')
 
 
     type = 0x07
@@ -360,10 +396,11 @@ class GoAwayFrame(Frame):
         self.error_code = fields[1]
         self.error_message = b''
         if len(data) > 8:
-            self.error_message = data[8:]
+            self.error_message = bytes(data[8:])
 
 
 class WindowUpdateFrame(Frame):
+    __slots__ = ('increment',)
     # 窗口控制增量
 
     type = 0x08
@@ -382,9 +419,10 @@ class WindowUpdateFrame(Frame):
         return _STRUCT_L.pack(self.increment & 0x7FFFFFFF)
 
     def parse_body(self, data):
-        self.increment = _STRUCT_L.unpack(data)[0] & 0x7FFFFFFF
+        self.increment = _STRUCT_L.unpack(data[0:4])[0] & 0x7FFFFFFF
 
 class ContinuationFrame(Frame):
+    __slots__ = ('data',)
 
 
     type = 0x09
@@ -422,6 +460,47 @@ _FRAME_CLASSES = [
 # 包含对应的帧类型值（字节）和帧类，{帧类型:帧对象}
 FRAMES = {cls.type: cls for cls in _FRAME_CLASSES}
 
+
+# 常用控制帧的序列化结果缓存，直接返回可发送的字节串而不创建帧对象
+# SETTINGS ACK帧：payload为空，ACK标志，stream_id为0
+SETTINGS_ACK = SettingsFrame(0, flags=('ACK',)).serialize()
+# PING ACK帧的首部，payload为8字节的opaque data
+_PING_ACK_HEADER = _STRUCT_HBBBL.pack(0, 8, PingFrame.type, FLAG_ACK, 0)
+
+
+@functools.lru_cache(maxsize=1024)
+def window_update_bytes(stream_id, increment):
+    # 返回WINDOW_UPDATE帧的序列化结果，相同的(stream_id, increment)直接命中缓存
+    if increment <= 0 or increment > WindowUpdateFrame._WINDOW_MAX_INCREMENT:
+        raise ValueError('Invalid window increment size. ')
+    return (_STRUCT_HBBBL.pack(0, 4, WindowUpdateFrame.type, 0,
+                               stream_id & 0x7FFFFFFF) +
+            _STRUCT_L.pack(increment & 0x7FFFFFFF))
+
+
+def ping_ack_bytes(opaque_data):
+    # 返回回应对端PING的ACK帧，原样携带8字节的opaque data
+    if len(opaque_data) != 8:
+        raise ValueError('opaque data length should be 8 bytes.')
+    return _PING_ACK_HEADER + opaque_data
+
+
+# 一次遍历接收缓冲区，为其中所有完整的帧建立索引，不创建任何帧对象
+# 返回([(type, flags, stream_id, offset, length), ...], 下一个未解析的位置)，
+# 其中offset为payload在data中的起始位置，不完整的帧留待下一次扫描
+def scan_frames(data, offset=0):
+    index = []
+    end = len(data)
+    unpack_from = _STRUCT_HBBBL.unpack_from
+    while end - offset >= 9:
+        high, low, type, flags, stream_id = unpack_from(data, offset)
+        length = (high << 8) + low
+        if end - offset - 9 < length:
+            break
+        index.append((type, flags, stream_id & 0x7FFFFFFF, offset + 9, length))
+        offset += 9 + length
+    return index, offset
+
 if __name__ == '__main__':
     pf = PingFrame(0)
     data = pf.serialize()
@@ -0,0 +1,163 @@
+import selectors
+import socket
+import threading
+import collections
+import heapq
+import itertools
+import time
+import logconfig, logging
+
+# 基于selectors的io事件循环：由单个线程负责所有连接的读写，
+# 仅在socket可读/可写、定时器到期或被其他线程唤醒时才醒来，空闲连接不产生任何开销
+
+
+class Timer(object):
+    # call_later返回的定时器，可在到期前取消
+    __slots__ = ('when', 'seq', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, seq, callback, args):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class IOLoop(object):
+    # handler需实现on_readable()，注册了EVENT_WRITE时还需实现on_writable()
+    # register/modify/unregister只能在循环线程中调用，其他线程通过call_soon_threadsafe提交
+    def __init__(self):
+        super(IOLoop, self).__init__()
+        self.selector = selectors.DefaultSelector()
+        # 用于其他线程唤醒循环的socketpair
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._lock = threading.Lock()
+        self._callbacks = collections.deque()
+        self._wakeup_pending = False
+        self._timers = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.run, name='h2-ioloop', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup()
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self._thread
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            # 缓冲区已满说明循环必然会被唤醒
+            pass
+
+    def call_soon_threadsafe(self, callback, *args):
+        # 在循环线程中执行callback(*args)
+        with self._lock:
+            self._callbacks.append((callback, args))
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        if not self.in_loop_thread():
+            self._wakeup()
+
+    def call_later(self, delay, callback, *args):
+        # delay秒后在循环线程中执行callback(*args)，返回Timer
+        timer = Timer(time.monotonic() + delay, next(self._seq), callback, args)
+        with self._lock:
+            heapq.heappush(self._timers, timer)
+            earliest = self._timers[0] is timer
+        if earliest and not self.in_loop_thread():
+            self._wakeup()
+        return timer
+
+    def register(self, sock, handler, events=selectors.EVENT_READ):
+        self.selector.register(sock, events, handler)
+
+    def modify(self, sock, handler, events):
+        self.selector.modify(sock, events, handler)
+
+    def unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _next_timeout(self):
+        # 有待执行的回调时不阻塞，没有定时器时无限期等待
+        with self._lock:
+            if self._callbacks:
+                return 0
+            while self._timers and self._timers[0].cancelled:
+                heapq.heappop(self._timers)
+            if not self._timers:
+                return None
+            return max(self._timers[0].when - time.monotonic(), 0)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _run_callbacks(self):
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, collections.deque()
+            self._wakeup_pending = False
+        for callback, args in callbacks:
+            self._call(callback, args)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._timers and self._timers[0].when <= now:
+                due.append(heapq.heappop(self._timers))
+        for timer in due:
+            if not timer.cancelled:
+                self._call(timer.callback, timer.args)
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('ioloop callback %r failed. ' % (callback,))
+
+    def run(self):
+        while not self._stopped:
+            for key, mask in self.selector.select(self._next_timeout()):
+                handler = key.data
+                if handler is None:
+                    self._drain_wakeup()
+                    continue
+                try:
+                    if mask & selectors.EVENT_READ:
+                        handler.on_readable()
+                    if mask & selectors.EVENT_WRITE:
+                        handler.on_writable()
+                except Exception:
+                    logging.exception('ioloop handler %r failed. ' % (handler,))
+            self._run_callbacks()
+            self._run_timers()
+        self.selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
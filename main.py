@@ -189,9 +189,9 @@ def test3():
 
     spider = H2Spider()
     t1 = time.time()
-    for i in range(1000):
-        res = spider.get(r1000[i])
-        print('spider: %s, headers: %s' % (i, res.headers))
+    # 同一服务器的请求在同一连接上并发发送
+    for i, (url, res, error) in enumerate(spider.get_many(r1000)):
+        print('spider: %s, headers: %s' % (i, res.headers if res else error))
     t2 = time.time()
     ts1000 = t2 - t1
     with open('./test/随机.txt', 'a') as fp:
@@ -51,6 +51,13 @@ class Settings(dict):
     def __contains__(self, item):
         return self.__settings.__contains__(item)
 
+    def __getitem__(self, item):
+        return self.__settings[item]
+
+    def __setitem__(self, key, value):
+        # 配置保存在内部字典中，属性访问（如max_concurrent_streams）读取的也是它
+        self.__settings[key] = value
+
     def __iter__(self):
         return self.__settings.__iter__()
 
@@ -1,102 +1,423 @@
 import ssl
 import socket
-from connection import H2Connection, ConnectionState
+import os
+import mmap
+from connection import H2Connection, ConnectionState, HpackPolicy
 import logconfig, logging
 from events import *
-import gzip,zlib
 import time
 import re
 import traceback
 import threading
+import collections
+import itertools
+import functools
+import queue
+import struct
+import selectors
+from ioloop import IOLoop
+from decoder import ContentDecoder
+from template import RequestTemplate
+from body import RequestBody
+
+class UnprocessedStreamError(ConnectionError):
+    # 对端明确表示没有处理该请求（goaway中的流id大于last_stream_id，或流被REFUSED_STREAM重置），
+    # 这类请求可以安全地在新连接上重放
+    pass
+
+
+class ConnectionUnavailableError(UnprocessedStreamError):
+    # 连接在请求发出之前已关闭或收到goaway，请求根本没有发出，可以转向其他连接重放（同样计入MAX_REPLAYS）
+    pass
+
+
+DEFAULT_DECODE = 'utf-8'
+_CHARSET_PATTERN = re.compile(r'charset=(\S+)')
+
+
+def _content_charset(headers):
+    # 从content-type中取得文本的编码，没有时使用DEFAULT_DECODE
+    content_type = headers.get('content-type', None)
+    if content_type:
+        de = _CHARSET_PATTERN.search(content_type)
+        if de:
+            return de.group(1)
+    return DEFAULT_DECODE
+
+
+def _is_informational(headers):
+    # 头部块是否为1xx的临时响应
+    for name, value in headers:
+        if name == ':status':
+            return value.startswith('1')
+    return False
+
 
 class H2Response(object):
     # 响应体
+    # 头部、content、text均在首次访问时才计算并缓存，只关心status或headers的调用方
+    # 不需要承担复制响应体、解压和文本解码的开销；解压也因此不占用io循环线程
+    __slots__ = ('_raw_headers', '_headers', '_data', '_max_size', '_content', '_decode', '_text')
 
+    # data: 接收到的原始响应体（未按content-encoding解压）
+    # max_size: 解压后响应体的最大长度，超出时读取content抛出ValueError，None表示不限制
+    def __init__(self, headers, data, max_size=None):
+        self._raw_headers = headers
+        self._headers = None
+        self._data = data
+        self._max_size = max_size
+        self._content = None
+        self._decode = None
+        self._text = None
 
-    def __init__(self, headers, data):
-        self.DEFAULT_DECODE = 'utf-8'
-        self.headers = headers
-        self.__parse_headers()
-        self.content = data
-        self.__decompress_data()
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = dict(self._raw_headers)
+            self._raw_headers = None
+        return self._headers
 
-        self.__decode = self.DEFAULT_DECODE
-        self.__decode_pattern = re.compile(r'charset=(\S+)')
-        self.__content_decode()
-        self.status = None
+    @property
+    def status(self):
+        return self._header(':status')
 
+    def _header(self, name):
+        # 读取单个头部，尚未构建头部字典时直接在头部列表中查找
+        if self._headers is not None:
+            return self._headers.get(name, None)
+        for key, value in self._raw_headers:
+            if key == name:
+                return value
+        return None
 
     @property
     def decode(self):
         # 手动设置解码方法
-        return self.__decode
+        if self._decode is None:
+            self._decode = _content_charset(self.headers)
+        return self._decode
 
     @decode.setter
     def decode(self, value):
-        self.__decode = value
-
-    def __content_decode(self):
-        content_type = self.headers.get('content-type',None)
-        if content_type:
-            de = self.__decode_pattern.search(content_type)
-            if de:
-                self.__decode = de.group(1)
-
-    def __parse_headers(self):
-        self.headers = dict(self.headers)
-        self.status = self.headers.get(':status', None)
+        if value != self._decode:
+            self._text = None
+        self._decode = value
 
-    def __decompress_data(self):
-        dcpr = self.headers.get('content-encoding',None)
-        if dcpr == 'gzip':
-            try:
-                self.content = gzip.decompress(self.content)
-            except:
-                traceback.print_exc()
-                print('the content:')
-                print(self.content)
-        if dcpr == 'deflate':
-            self.content = zlib.decompress(self.content)
+    @property
+    def content(self):
+        # 首次访问时按content-encoding解压，解压失败或超出max_size时抛出ValueError
+        if self._content is None:
+            decoder = ContentDecoder(self._header('content-encoding'), self._max_size)
+            if decoder.passthrough:
+                self._content = bytes(self._data)
+            else:
+                self._content = decoder.decompress(self._data) + decoder.flush()
+            # 转换后不再持有接收缓冲区
+            self._data = None
+        return self._content
 
     @property
     def text(self):
-        return self.content.decode(self.decode,'ignore')
+        if self._text is None:
+            self._text = self.content.decode(self.decode, 'ignore')
+        return self._text
 
 
 class RawResponse(object):
-    # 临时数据存储
-    def __init__(self):
+    # 临时数据存储，同时作为等待该流响应完成的future
+    # streaming: 流式读取响应体，DATA帧的数据进入chunks队列，由使用者通过read_chunk逐块取出
+    # max_size: 响应体的最大长度，None表示不限制；缓冲读取时按接收到的（未解压的）长度限制，
+    # 解压后的长度由H2Response在读取content时限制，流式读取时由使用者线程的解压器限制
+    def __init__(self, streaming=False, max_size=None):
         super(RawResponse, self).__init__()
+        self.stream_id = None
         self.headers = b''
-        self.data = b''
+        # DATA帧的payload为接收缓冲区的memoryview，直接追加到bytearray中只复制一次
+        self.data = bytearray()
+        self.streaming = streaming
+        self.max_size = max_size
+        # 已写入的响应体长度
+        self.size = 0
+        # 流式读取时尚未被取走的[(bytes, 占用的流量窗口)]
+        self.chunks = collections.deque()
         self.lock = threading.Lock()
+        self._readable = threading.Condition(self.lock)
         self.completed = False
+        # 流被重置或连接断开时记录异常
+        self.error = None
+        self._headers_ready = threading.Event()
+        self._done = threading.Event()
+        self._callbacks = []
+
+    def set_headers(self, headers):
+        # 之后的头部（trailers）不覆盖响应头部
+        if self._headers_ready.is_set():
+            return
+        if _is_informational(headers):
+            # 1xx（100 Continue、103 Early Hints等）之后还会有最终响应的头部
+            return
+        self.headers = headers
+        self._headers_ready.set()
+
+    def write(self, event):
+        # 缓冲读取：写入一个DATA帧的数据（不解压），超出max_size时抛出ValueError
+        self.size += event.write_to(self.data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ValueError('content is larger than %s bytes. ' % self.max_size)
+
+    def feed(self, data, flow_length):
+        # 流式读取：由io循环放入一块数据
+        with self.lock:
+            self.chunks.append((data, flow_length))
+            self._readable.notify()
+
+    def read_chunk(self):
+        # 流式读取：取出一块数据，返回(bytes, 占用的流量窗口)，数据读完返回(None, 0)，出错时抛出异常
+        with self.lock:
+            while not self.chunks and not self.completed:
+                self._readable.wait()
+            if self.chunks:
+                return self.chunks.popleft()
+            if self.error is not None:
+                raise self.error
+            return None, 0
+
+    def finish(self, error=None):
+        # 标记响应结束（正常结束或出错），唤醒等待者并执行回调
+        with self.lock:
+            if self.completed:
+                return
+            self.completed = True
+            self.error = error
+            callbacks, self._callbacks = self._callbacks, []
+            self._readable.notify_all()
+        self._headers_ready.set()
+        self._done.set()
+        for callback in callbacks:
+            # 单个回调出错不影响其他回调，也不影响调用方（通常是io循环）
+            try:
+                callback(self)
+            except Exception:
+                logging.exception('done callback %r failed. ' % (callback,))
+
+    def wait_headers(self, timeout=None):
+        # 等待响应头部到达（或响应出错），返回是否已到达
+        return self._headers_ready.wait(timeout)
+
+    def add_done_callback(self, callback):
+        # 响应结束后调用callback(self)，已结束则立即调用
+        with self.lock:
+            if not self.completed:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        # 等待响应结束，返回是否已结束
+        return self._done.wait(timeout)
+
+
+class StreamAdmission(object):
+    # 单个连接的流准入队列：按对端MAX_CONCURRENT_STREAMS限制同时打开的流数量，
+    # 超出限制的请求按先后顺序排队，由流关闭或对端settings变化唤醒，不进行轮询
+    def __init__(self, conn):
+        super(StreamAdmission, self).__init__()
+        self.conn = conn
+        self.lock = threading.Lock()
+        # 已获得名额但尚未发送headers（流尚未创建）的请求数
+        self.reserved = 0
+        self.waiters = collections.deque()
+        # 连接不可用的原因，设置后不再分配名额
+        self.error = None
+
+    def _has_slot(self):
+        return self.conn.available_stream_slots > self.reserved
+
+    @property
+    def free_slots(self):
+        # 扣除已预留和排队中的请求后，还能立即打开的流数量
+        return max(self.conn.available_stream_slots - self.reserved - len(self.waiters), 0)
+
+    def _admit(self):
+        # 调用时需持有self.lock
+        while self.waiters and self._has_slot():
+            self.reserved += 1
+            self.waiters.popleft().set()
+
+    def acquire(self, timeout=None):
+        # 获取一个流名额，超时返回False；连接不可用时抛出ConnectionUnavailableError
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            if not self.waiters and self._has_slot():
+                self.reserved += 1
+                return True
+            waiter = threading.Event()
+            # 由fail_all唤醒时记录原因，此时并未分配名额
+            waiter.error = None
+            self.waiters.append(waiter)
+        if not waiter.wait(timeout):
+            with self.lock:
+                try:
+                    self.waiters.remove(waiter)
+                    return False
+                except ValueError:
+                    # 超时的同时已被唤醒
+                    pass
+        if waiter.error is not None:
+            raise waiter.error
+        return True
+
+    def stream_opened(self):
+        # 流已创建，名额转由conn.open_stream_count计数
+        with self.lock:
+            self.reserved -= 1
+
+    def release(self):
+        # 获得名额后未能创建流，归还名额
+        with self.lock:
+            self.reserved -= 1
+            self._admit()
+
+    def stream_closed(self):
+        # 流关闭或对端配置变化后，唤醒排队中的请求
+        with self.lock:
+            self._admit()
+
+    settings_changed = stream_closed
+
+    def fail_all(self, error):
+        # 连接不可用时唤醒所有等待者，等待者与之后的acquire抛出error
+        with self.lock:
+            self.error = error
+            waiters, self.waiters = self.waiters, collections.deque()
+        for waiter in waiters:
+            waiter.error = error
+            waiter.set()
 
 
 class H2Socket(object):
     # 用于h2通信的socket
     DEFAULT_PORT = 443
+    # 预分配的接收缓冲区大小，每次recv_into最多读取该长度
+    RECV_BUFFER_SIZE = 2 ** 18
+    # 小于该长度的待发送缓冲区会被合并后写出；需大于默认的最大帧长度（16KB）加9字节帧首部，
+    # 满长度的DATA帧才会与其帧首部及相邻的帧一起写出，在TLS上组成完整的记录，而不是单独为帧首部写一次
+    COALESCE_LIMIT = 2 ** 16
+    # 单次sendmsg最多携带的缓冲区个数
+    IOV_MAX = 1024
 
-    def __init__(self, host, port=443, timeout=1):
+    # sock: 可传入已建立连接的socket（如测试或代理场景），否则新建TLS连接
+    def __init__(self, host, port=443, timeout=1, sock=None):
         super(H2Socket, self).__init__()
-        context = ssl.create_default_context()
-        context.set_alpn_protocols(['h2'])
-        s = socket.create_connection((host, port))
-        s.settimeout(timeout)
-        self.sock = context.wrap_socket(s, server_hostname=host)
+        if sock is None:
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(['h2'])
+            s = socket.create_connection((host, port))
+            s.settimeout(timeout)
+            # 关闭Nagle算法，避免小帧（headers、ping）被延迟发送
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock = context.wrap_socket(s, server_hostname=host)
+        self.sock = sock
         self.time_wait = 0
         self.lock = threading.RLock()
+        # 接收缓冲区在连接生命周期内复用，避免每次recv都分配新的bytes对象
+        self._recv_buffer = bytearray(self.RECV_BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
 
     def sendall(self, data):
 
         response = self.sock.sendall(data)
         return response
 
+    def coalesce(self, buffers):
+        # 将连续的小块缓冲区合并，每块合并到COALESCE_LIMIT左右，不小于COALESCE_LIMIT的缓冲区原样保留
+        pending = []
+        size = 0
+        for buffer in buffers:
+            length = len(buffer)
+            if length >= self.COALESCE_LIMIT:
+                if pending:
+                    yield b''.join(pending)
+                    pending = []
+                    size = 0
+                yield buffer
+                continue
+            pending.append(buffer)
+            size += length
+            if size >= self.COALESCE_LIMIT:
+                yield b''.join(pending)
+                pending = []
+                size = 0
+        if pending:
+            yield b''.join(pending)
+
+    def write_pending(self, buffers):
+        # 非阻塞模式下尽量写出缓冲区队列（collections.deque），已写出的部分从队列中移除
+        # 未写完的缓冲区保留在队首，下次可写时以相同内容重试（SSL要求）
+        if isinstance(self.sock, ssl.SSLSocket):
+            while buffers:
+                try:
+                    sent = self.sock.send(buffers[0])
+                except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                    return
+                if sent < len(buffers[0]):
+                    buffers[0] = memoryview(buffers[0])[sent:]
+                    return
+                buffers.popleft()
+            return
+        while buffers:
+            try:
+                sent = self.sock.sendmsg(list(itertools.islice(buffers, self.IOV_MAX)))
+            except BlockingIOError:
+                return
+            while sent:
+                length = len(buffers[0])
+                if sent < length:
+                    buffers[0] = memoryview(buffers[0])[sent:]
+                    return
+                sent -= length
+                buffers.popleft()
+            while buffers and not len(buffers[0]):
+                buffers.popleft()
+
     def recv(self, buf_size):
 
         response = self.sock.recv(buf_size)
         return response
 
+    def recv_into(self, buffer, nbytes=0):
+
+        response = self.sock.recv_into(buffer, nbytes)
+        return response
+
+    def setblocking(self, flag):
+
+        self.sock.setblocking(flag)
+
+    def fileno(self):
+
+        return self.sock.fileno()
+
+    def pending(self):
+        # SSL层已解密但尚未读取的字节数，这部分数据不会触发selector的可读事件
+        if isinstance(self.sock, ssl.SSLSocket):
+            return self.sock.pending()
+        return 0
+
+    def recv_view(self):
+        # 将数据读入预分配的缓冲区，返回本次读到的数据视图
+        # 视图在下一次读取前有效，使用者需在此之前处理完毕
+        length = self.sock.recv_into(self._recv_view)
+        if not length:
+            raise ConnectionResetError('connection closed by remote. ')
+        return self._recv_view[:length]
+
+    def receive_into(self, conn):
+        # 将数据读入预分配的缓冲区，并直接交由conn解析，返回解析得到的事件
+        # conn.receive_data会将数据复制进帧缓冲区，因此接收缓冲区可立即复用
+        return conn.receive_data(self.recv_view())
+
     def close(self):
 
         response = self.sock.close()
@@ -106,268 +427,601 @@ class H2Socket(object):
         # 更新挂起时间
         self.time_wait = time.perf_counter() - self.time_wait
 
-# h2请求的封装，类似h1中的request
-class H2Spider(object):
-    # h2请求的处理爬虫
+class H2Session(object):
+    # 一个h2连接（socket + H2Connection）及其上的所有流
+    # socket注册在IOLoop中，由循环线程负责读写并按stream_id将事件分发给各请求的RawResponse；
+    # 多个线程可以同时在同一连接上发起请求，请求线程只操作conn，发送交由循环线程完成
+    # 单次可读事件中最多连续读取的次数，避免单个繁忙连接占满循环
+    MAX_READS_PER_EVENT = 64
+    # RST_STREAM错误码：对端拒绝处理该流；本端取消该流
+    REFUSED_STREAM = 0x7
+    CANCEL = 0x8
+    # 单个流排队待发送的请求体数据上限，超出时上传线程等待对端的WINDOW_UPDATE
+    MAX_PENDING_BODY = 2 ** 18
+
+    def __init__(self, host, port, loop, timeout=1, hpack_policy=None):
+        super(H2Session, self).__init__()
+        self.host = host
+        self.port = port
+        self.loop = loop
+        # 建立连接和TLS握手仍为阻塞操作（受timeout限制），完成后切换为非阻塞模式
+        self.sock = H2Socket(host, port, timeout=timeout)
+        self.sock.setblocking(False)
+        self.conn = H2Connection(hpack_policy=hpack_policy)
+        self.admission = StreamAdmission(self.conn)
+        # 保护conn的状态
+        self.lock = threading.RLock()
+        # 进行中的请求 {stream_id: RawResponse}
+        self.responses = {}
+        self.closed = False
+        # 最近一次发起请求或收到响应的时间，用于淘汰空闲连接
+        self.last_active = time.monotonic()
+        # 最近一次收到任何数据（包括PING的ACK）的时间
+        self.last_received = self.last_active
+        # 保活：尚未收到ACK的PING的发送时间及其opaque data，以及最近一次测得的往返时间（秒）
+        self.ping_sent_at = None
+        self._ping_payload = None
+        self.rtt = None
+        # 正在上传请求体的流 {stream_id: threading.Condition}，由该流的窗口更新或响应结束唤醒
+        self._writers = {}
+        # 以下属性只在循环线程中访问
+        # 尚未写出的缓冲区
+        self._outbound = collections.deque()
+        self._events = selectors.EVENT_READ
+        # 已提交但尚未执行的发送任务
+        self._flush_scheduled = False
+        with self.lock:
+            self.conn.initiate_connection()
+            self._schedule_flush()
+        loop.call_soon_threadsafe(self.loop.register, self.sock, self)
+        loop.start()
+
+    def __repr__(self):
+        return '<H2Session %s:%s>' % (self.host, self.port)
+
+    @property
+    def active_count(self):
+        # 进行中的请求数量
+        return len(self.responses)
+
+    @property
+    def usable(self):
+        # 连接未关闭且未收到对端的goaway
+        return not self.closed and self.conn.status != ConnectionState.CLOSED
+
+    @property
+    def load(self):
+        # 连接负载，用于选择连接：进行中的流越少、对端给出的发送窗口越大越优先
+        return (self.active_count, -self.conn.outbound_flow_control_window)
+
+    def _schedule_flush(self):
+        # 调用时需持有self.lock，通知循环线程发送conn中待发送的数据
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon_threadsafe(self._flush)
+
+    def submit(self, template, path, body=None, streaming=False, max_size=None):
+        # 按请求模板发送请求头部，有请求体（RequestBody）时在当前线程中上传，
+        # 返回该流对应的RawResponse，可通过wait()等待其完成
+        self.admission.acquire()
+        with self.lock:
+            if not self.usable:
+                self.admission.release()
+                raise ConnectionUnavailableError('connection(%s:%s) is closed. ' % (self.host, self.port))
+            stream_id = self.conn.get_next_available_stream()
+            if not stream_id:
+                self.admission.release()
+                raise ValueError('stream ids of connection(%s:%s) are exhausted. '
+                                 % (self.host, self.port))
+            response = RawResponse(streaming, max_size)
+            response.stream_id = stream_id
+            self.responses[stream_id] = response
+            self.conn.send_request_headers(stream_id, template, path, end_stream=body is None,
+                                           extra=body.headers() if body is not None else ())
+            self.admission.stream_opened()
+            self.last_active = time.monotonic()
+            self._schedule_flush()
+        if body is not None:
+            self._send_body(response, body)
+        return response
+
+    def _send_body(self, response, body):
+        # 逐块读取请求体交给conn发送，排队的数据达到MAX_PENDING_BODY时等待窗口更新；
+        # 对端提前结束响应或连接不可用时停止上传
+        stream_id = response.stream_id
+        with self.lock:
+            self._writers[stream_id] = threading.Condition(self.lock)
+        try:
+            for chunk in body.chunks():
+                with self.lock:
+                    if not self._wait_writable(response):
+                        return
+                    self._send_data(stream_id, chunk)
+            with self.lock:
+                if self._wait_writable(response):
+                    self._send_data(stream_id, b'', end_stream=True)
+        except Exception:
+            # 读取请求体失败，放弃该流
+            self.cancel(stream_id)
+            raise
+        finally:
+            with self.lock:
+                self._writers.pop(stream_id, None)
+
+    def _wait_writable(self, response):
+        # 调用时需持有self.lock，返回是否可以继续发送该流的请求体
+        stream_id = response.stream_id
+        while (not response.completed and not self.closed
+               and self.conn.pending_data_size(stream_id) >= self.MAX_PENDING_BODY):
+            self._writers[stream_id].wait()
+        if response.completed or self.closed or stream_id not in self.conn.streams:
+            if not self.closed and stream_id in self.conn.streams:
+                # 响应已结束但本端尚未结束该流，重置以释放流名额
+                self.conn.send_rst_stream(stream_id, error_code=self.CANCEL)
+                self.admission.stream_closed()
+                self._schedule_flush()
+            return False
+        return True
+
+    def _send_data(self, stream_id, data, end_stream=False):
+        # 调用时需持有self.lock
+        if self.conn.send_data(stream_id, data, end_stream=end_stream):
+            # 发送END_STREAM后流关闭
+            self.admission.stream_closed()
+        self._schedule_flush()
+
+    def _wake_writers(self, stream_id=0):
+        # 调用时需持有self.lock：唤醒等待该流发送窗口的上传线程，stream_id为0时唤醒全部
+        if stream_id:
+            writer = self._writers.get(stream_id)
+            if writer is not None:
+                writer.notify()
+            return
+        for writer in self._writers.values():
+            writer.notify()
+
+    def ack_stream_data(self, stream_id, length):
+        # 流式读取：使用者取走数据后再归还流级窗口，对端才能继续发送该流的数据
+        with self.lock:
+            self.conn.ack_stream_data_received(length, stream_id)
+            self._schedule_flush()
+
+    def cancel(self, stream_id):
+        # 放弃尚未完成的流：发送RST_STREAM(CANCEL)并结束对应的RawResponse
+        with self.lock:
+            response = self.responses.pop(stream_id, None)
+            if response is None:
+                return
+            if self.usable and stream_id in self.conn.streams:
+                self.conn.send_rst_stream(stream_id, error_code=self.CANCEL)
+                self._schedule_flush()
+        response.finish(ConnectionError('stream %s was cancelled. ' % stream_id))
+        self.admission.stream_closed()
+        with self.lock:
+            self._wake_writers(stream_id)
+
+    def send_ping(self):
+        # 发送PING，收到对应的ACK后更新rtt
+        with self.lock:
+            self.ping_sent_at = time.monotonic()
+            self._ping_payload = struct.pack('>d', self.ping_sent_at)
+            self.conn.send_ping(self._ping_payload)
+            self._schedule_flush()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.conn.close_connection()
+        self.loop.call_soon_threadsafe(self._close_in_loop)
+
+    def _close_in_loop(self):
+        # 尽量发出goaway后关闭socket
+        self._flush()
+        self._abort(ConnectionError('connection(%s:%s) is closed. ' % (self.host, self.port)))
+
+    def _abort(self, error):
+        # 在循环线程中调用：注销并关闭socket，结束所有进行中的请求
+        self.closed = True
+        self.loop.unregister(self.sock)
+        self.sock.close()
+        self._outbound.clear()
+        self._fail_all(error)
+
+    def _fail_all(self, error):
+        with self.lock:
+            responses, self.responses = self.responses, {}
+        for response in responses.values():
+            response.finish(error)
+        # 排队中的请求尚未发出，交由调用方转向其他连接；唤醒上传中的线程，使其发现连接已不可用
+        self.admission.fail_all(ConnectionUnavailableError(
+            'connection(%s:%s) is closed: %s' % (self.host, self.port, error)))
+        with self.lock:
+            self._wake_writers()
+
+    def _flush(self):
+        # 在循环线程中调用：写出待发送数据，写不完时关注可写事件
+        if self.sock.sock.fileno() < 0:
+            return
+        with self.lock:
+            self._flush_scheduled = False
+            buffers = self.conn.buffers_to_send()
+        if buffers:
+            self._outbound.extend(self.sock.coalesce(buffers))
+        try:
+            self.sock.write_pending(self._outbound)
+        except OSError as e:
+            logging.info('connection(%s:%s) write failed: %s' % (self.host, self.port, e))
+            self._abort(e)
+            return
+        events = selectors.EVENT_READ
+        if self._outbound:
+            events |= selectors.EVENT_WRITE
+        if events != self._events:
+            self._events = events
+            self.loop.modify(self.sock, self, events)
+
+    def on_writable(self):
+        self._flush()
+
+    def on_readable(self):
+        # 读取直到socket中暂无数据，再统一发送响应产生的控制帧（ack、窗口更新等）
+        self.last_received = time.monotonic()
+        for _ in range(self.MAX_READS_PER_EVENT):
+            try:
+                view = self.sock.recv_view()
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                break
+            except (OSError, ValueError) as e:
+                if not self.closed:
+                    logging.info('connection(%s:%s) read failed: %s' % (self.host, self.port, e))
+                self._abort(e)
+                return
+            finished = []
+            try:
+                with self.lock:
+                    # 事件持有帧缓冲区的视图，不保留事件列表的引用，
+                    # 下一次读取时帧缓冲区才能原地扩容和整理，无需复制未解析的数据
+                    self._dispatch(self.conn.receive_data(view), finished)
+            except Exception as e:
+                # 协议错误、hpack解码失败、帧格式错误等，连接状态已不可信，结束所有请求；
+                # 已从responses中取出的请求按各自的结果结束
+                logging.info('connection(%s:%s) failed: %r' % (self.host, self.port, e))
+                for response, error in finished:
+                    response.finish(error)
+                self._abort(e)
+                return
+            for response, error in finished:
+                response.finish(error)
+            if finished and self._writers:
+                # 响应已结束，仍在上传请求体的线程应停止上传
+                with self.lock:
+                    for response, _ in finished:
+                        self._wake_writers(response.stream_id)
+        else:
+            # 达到单次读取上限，SSL层中可能还有已解密的数据，稍后继续读取
+            if self.sock.pending():
+                self.loop.call_soon_threadsafe(self.on_readable)
+        if self.conn.status == ConnectionState.CLOSED and not self.responses:
+            # 收到goaway后，已被对端接受的请求全部完成，关闭连接
+            self.close()
+        self._flush()
+
+    def _dispatch(self, events, finished):
+        # 调用时需持有self.lock，已结束的(RawResponse, error)加入finished，在释放锁后再通知
+        for e in events:
+            if isinstance(e, (StreamClosed, SettingsReceived)):
+                self.admission.stream_closed()
+                if getattr(e, 'error_code', None) is not None:
+                    # 对端在该流上违反协议，本端已重置该流
+                    response = self.responses.pop(e.stream_id, None)
+                    if response is not None:
+                        finished.append((response, ConnectionError(
+                            'stream %s was reset by local(error code: %s). ' % (e.stream_id, e.error_code))))
+                continue
+            elif isinstance(e, WindowUpdated):
+                # 发送窗口增大，唤醒等待该流（stream_id为0时为全部流）发送窗口的上传线程
+                self._wake_writers(e.stream_id)
+                continue
+            elif isinstance(e, HeadersReceived):
+                self.last_active = self.last_received
+                response = self.responses.get(e.stream_id)
+                if response is not None:
+                    response.set_headers(e.headers)
+            elif isinstance(e, DataReceived):
+                self.last_active = self.last_received
+                response = self.responses.get(e.stream_id)
+                if response is not None and response.streaming:
+                    # 接收缓冲区会被复用，需复制出来；流级窗口待使用者读取后再归还
+                    response.feed(e.data, e.flow_window_length)
+                    self.conn.ack_data_received(e.flow_window_length)
+                else:
+                    if response is not None:
+                        try:
+                            response.write(e)
+                        except Exception as error:
+                            # 响应体过大，放弃该流
+                            self._reset_stream(e.stream_id)
+                            finished.append((response, error))
+                    self.conn.ack_data_received(e.flow_window_length, e.stream_id)
+            elif isinstance(e, PingReceived):
+                if e.ACK and self.ping_sent_at is not None and e.data == self._ping_payload:
+                    self.rtt = time.monotonic() - self.ping_sent_at
+                    self.ping_sent_at = None
+                continue
+            elif isinstance(e, RstStreamReceived):
+                response = self.responses.pop(e.stream_id, None)
+                if response is not None:
+                    # REFUSED_STREAM表示对端未处理该流
+                    error_class = (UnprocessedStreamError if e.error_code == self.REFUSED_STREAM
+                                   else ConnectionError)
+                    finished.append((response, error_class(
+                        'stream %s was reset(error code: %s). ' % (e.stream_id, e.error_code))))
+                continue
+            elif isinstance(e, GoawayReceived):
+                # 连接进入排空状态：不再接受新请求，id大于last_stream_id的请求未被处理，
+                # 交由调用方在新连接上重放，其余请求继续在本连接上完成
+                logging.info('%r received goaway(last_stream_id:%s, error_code:%s). ' % (
+                    self, e.last_stream_id, e.error_code))
+                for stream_id in [i for i in self.responses if i > e.last_stream_id]:
+                    finished.append((self.responses.pop(stream_id), UnprocessedStreamError(
+                        'stream %s was not processed by %s:%s before goaway. '
+                        % (stream_id, self.host, self.port))))
+                # 排队中的请求不会再被本连接接受，使其转向其他连接
+                self.admission.fail_all(ConnectionUnavailableError(
+                    'connection(%s:%s) received goaway. ' % (self.host, self.port)))
+                continue
+            if getattr(e, 'end_stream', False):
+                response = self.responses.pop(e.stream_id, None)
+                if response is not None:
+                    finished.append((response, None))
+
+    def _reset_stream(self, stream_id):
+        # 调用时需持有self.lock：不再接收该流的响应
+        self.responses.pop(stream_id, None)
+        if stream_id in self.conn.streams:
+            self.conn.send_rst_stream(stream_id, error_code=self.CANCEL)
+
+
+class KeepaliveManager(object):
+    # 连接保活：在io循环中定期检查连接池中的所有连接
+    # 空闲超过ping_interval的连接发送PING并由ACK测量rtt；
+    # PING超过ping_timeout未得到回应的连接视为失效，关闭后重新建立；
+    # 没有进行中请求且空闲超过idle_timeout的连接直接关闭
+    # 请求路径不再需要为检查连接可用性付出任何代价
+    def __init__(self, spider, loop, idle_timeout=300, ping_interval=30, ping_timeout=10):
+        super(KeepaliveManager, self).__init__()
+        self.spider = spider
+        self.loop = loop
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.check_interval = max(min(idle_timeout, ping_interval, ping_timeout) / 2, 0.1)
+        self._timer = None
+
+    def start(self):
+        self._timer = self.loop.call_later(self.check_interval, self._check)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _check(self):
+        now = time.monotonic()
+        for session in self.spider._pooled_sessions():
+            if session.ping_sent_at is not None:
+                if now - session.ping_sent_at > self.ping_timeout:
+                    logging.info('%r did not answer ping in %ss, replace it. ' % (session, self.ping_timeout))
+                    self.spider._drop_session(session, replace=True)
+                continue
+            idle = now - session.last_active
+            if not session.active_count and idle > self.idle_timeout:
+                logging.info('%r idle for %.0fs, close it. ' % (session, idle))
+                self.spider._drop_session(session)
+            elif now - max(session.last_received, session.last_active) > self.ping_interval:
+                session.send_ping()
+        self.start()
+
+
+class H2StreamingResponse(object):
+    # 流式响应：头部到达即返回，响应体随DATA帧到达逐块读取
+    # 使用者读取数据后才归还流级窗口，未读取的数据最多为一个流量窗口，内存占用有上限
+    def __init__(self, session, raw):
+        super(H2StreamingResponse, self).__init__()
+        self.session = session
+        self.raw = raw
+        self.headers = dict(raw.headers)
+        self.status = self.headers.get(':status', None)
+        self.decode = _content_charset(self.headers)
+        # 由使用者线程随读取逐块解压
+        self.decoder = ContentDecoder(self.headers.get('content-encoding'), raw.max_size)
+        self._consumed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def iter_content(self, chunk_size=None):
+        # chunk_size为None时按DATA帧到达的大小产生数据块，否则按chunk_size重新分块
+        if self._consumed:
+            raise ValueError('the content of streaming response has already been consumed. ')
+        self._consumed = True
+        pending = bytearray()
+        while True:
+            data, flow_length = self.raw.read_chunk()
+            if flow_length:
+                self.session.ack_stream_data(self.raw.stream_id, flow_length)
+            try:
+                if data is None:
+                    data = self.decoder.flush()
+                    if data:
+                        pending += data
+                    break
+                data = self.decoder.decompress(data)
+            except ValueError:
+                self.close()
+                raise
+            if chunk_size is None:
+                if data:
+                    yield data
+                continue
+            pending += data
+            while len(pending) >= chunk_size:
+                yield bytes(pending[:chunk_size])
+                del pending[:chunk_size]
+        if pending:
+            yield bytes(pending)
+
+    def iter_lines(self, chunk_size=None, delimiter=None):
+        # 按行产生响应体（不含换行符），跨数据块的行会被拼接完整
+        tail = b''
+        for chunk in self.iter_content(chunk_size):
+            chunk = tail + chunk
+            if delimiter:
+                lines = chunk.split(delimiter)
+                tail = lines.pop()
+            else:
+                lines = chunk.splitlines(True)
+                # 最后一行可能尚不完整（以\r结尾时\n可能在下一块中），留到下一块
+                tail = lines.pop() if lines and not lines[-1].endswith(b'\n') else b''
+                lines = [self._strip_line_end(line) for line in lines]
+            for line in lines:
+                yield line
+        if tail:
+            yield tail if delimiter else self._strip_line_end(tail)
+
+    @staticmethod
+    def _strip_line_end(line):
+        if line.endswith(b'\r\n'):
+            return line[:-2]
+        if line.endswith((b'\n', b'\r')):
+            return line[:-1]
+        return line
+
+    @property
+    def content(self):
+        # 读取剩余的全部响应体
+        return b''.join(self.iter_content())
+
+    @property
+    def text(self):
+        return self.content.decode(self.decode, 'ignore')
+
+    def close(self):
+        # 未读完时取消该流
+        if not self.raw.completed:
+            self.session.cancel(self.raw.stream_id)
+
+
+def _preallocate(fp, length, max_size=None):
+    # 按content-length预先分配文件空间，减少写入过程中的文件扩展和碎片，返回预分配的长度
+    if max_size is not None and length > max_size:
+        return 0
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fp.fileno(), 0, length)
+        else:
+            fp.truncate(length)
+    except (OSError, ValueError):
+        # 不支持预分配的文件系统或非真实文件，直接顺序写入
+        return 0
+    return length
+
+
+class H2FileResponse(object):
+    # download的结果：响应体已直接写入文件path，content为该文件的只读mmap，
+    # 按需由操作系统换页读取，不占用额外内存
+    def __init__(self, headers, path):
+        super(H2FileResponse, self).__init__()
+        self.headers = dict(headers)
+        self.status = self.headers.get(':status', None)
+        self.path = path
+        self.size = os.path.getsize(path)
+        self._file = None
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def content(self):
+        # 空文件无法映射，返回b''
+        if not self.size:
+            return b''
+        if self._mmap is None:
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+
+class BaseSpider(object):
+    # H2Spider与AsyncH2Spider共用的部分：url解析、请求模板的构建与缓存、重放策略，
+    # 不涉及连接和io，具体的请求接口由子类提供
     DEFAULT_HEADERS = {
         # 'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
         'accept-encoding': 'gzip, deflate',
         ':scheme': 'https',
         'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.88 Safari/537.36'
     }
-    def __init__(self, max_connection=4, timeout=1):
-        super(H2Spider,self).__init__()
+    # 对端未处理时可以安全重放的请求方法，以及单个请求最多重放的次数
+    # 每次重放都计入次数（包括请求尚未发出即转向其他连接），连接反复失效或反复收到goaway时不会无限重试
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+    MAX_REPLAYS = 3
+    # 缓存的请求模板数量上限
+    MAX_TEMPLATES = 256
+
+    # max_connection: 所有服务器的连接总数上限
+    # max_content_size: 解压后响应体的最大长度，超出时抛出ValueError（缓冲读取时在读取content时解压并检查），
+    # None表示不限制
+    # hpack_policy: 头部压缩策略（HpackPolicy），None时使用默认策略
+    def __init__(self, max_connection=4, timeout=1, max_content_size=None, hpack_policy=None):
+        super(BaseSpider, self).__init__()
         self.timeout = timeout
-        self.__socks_conns = {}
         self.max_connection = max_connection
+        self.max_content_size = max_content_size
+        self.hpack_policy = hpack_policy if hpack_policy is not None else HpackPolicy()
+        # 请求模板 {(method, host, 自定义头部): RequestTemplate}
+        self.__templates = {}
         # 用于解析服务器名和端口的正则表达式
         self.__host_pattern = re.compile(r'https://([^/:]+)/?')
         self.__port_pattern = re.compile(r'https://\S+?:(\d+)/?')
         self.__path_pattern = re.compile(r'https://\S+?/(\S+?)$')
-        self.response_data = {}
 
-    def request(self,method,url=None, headers=None, proxy = None ):
-        method = method.upper()
-        host = self._parse_host(url)
-        port = self._parse_port(url)
-        #print(host,port)
-        sock, conn = self.__get_sock_conn(host, port)
-        with sock.lock:
-            conn.status = ConnectionState.OPEN
-            stream_id = 0
-            while not stream_id:
-                stream_id = conn.get_next_available_stream()
-                if not stream_id:
-                    time.sleep(1)
-            id = (host, port, stream_id)
-            # self.response_data[id] = RawResponse()
-            if method:
-
-                h2headers = self._build_headers('GET', url, headers)
-                # with sock.lock:
-                conn.send_headers(stream_id, h2headers, end_stream=True)
-                sock.sendall(conn.data_to_send())
-                if_break = False
-                while not if_break:
-                    try:
-                        data = sock.recv(65535)
-                    except socket.timeout:
-                        try:
-                            if self.response_data[id].completed:
-                                if_break = True
-                        except KeyError:
-                            pass
-                        continue
-                    #with sock.lock:
-                    events = conn.receive_data(data)
-                    received = {}
-                    # print(events)
-                    for e in events:
-                        if isinstance(e, (HeadersReceived, DataReceived)):
-                            if e.end_stream:
-                                try:
-                                    with self.response_data[(host, port, e.stream_id)].lock:
-                                        self.response_data[(host, port, e.stream_id)].completed = True
-                                except KeyError:
-                                    self.response_data[(host, port, e.stream_id)] = RawResponse()
-                                    with self.response_data[(host, port, e.stream_id)].lock:
-                                        self.response_data[(host, port, e.stream_id)].completed = True
-                                # self.response_data[url].compeleted = True
-                                if e.stream_id == stream_id:
-                                    if_break = True
-                            if isinstance(e, HeadersReceived) :
-                                try:
-                                    with self.response_data[(host, port, e.stream_id)].lock:
-                                        self.response_data[(host, port, e.stream_id)].headers = e.headers
-                                except KeyError:
-                                    self.response_data[(host, port, e.stream_id)] = RawResponse()
-                                    with self.response_data[(host, port, e.stream_id)].lock:
-                                        self.response_data[(host, port, e.stream_id)].headers = e.headers
-
-                            if isinstance(e,DataReceived):
-                                if e.data:
-                                    try:
-                                        with self.response_data[(host, port, e.stream_id)].lock:
-                                            self.response_data[(host,port,e.stream_id)].data += e.data
-                                    except KeyError:
-
-                                        self.response_data[(host, port, e.stream_id)] = RawResponse()
-                                        with self.response_data[(host, port, e.stream_id)].lock:
-                                            self.response_data[(host, port, e.stream_id)].data += e.data
-
-                                    # self.response_data[url].data += e.data
-
-                                try:
-                                    received[e.stream_id] += e.flow_window_length
-                                except KeyError:
-                                    received[e.stream_id] = e.flow_window_length
-                    for sid, ack_len in received.items():
-                        conn.ack_data_received(ack_len,sid)
-                        sock.sendall(conn.data_to_send())
-                r = self.response_data.pop(id)
-                response = H2Response(r.headers, r.data)
-                sock.refresh_wait_time()
-        conn.status = ConnectionState.CLOSED
-        return response
-
-    def another_request(self,method,url=None, headers=None, proxy = None ):
-
-        method = method.upper()
-        host = self._parse_host(url)
-        port = self._parse_port(url)
-        # print(host,port)
-        sock, conn = self.__get_sock_conn(host, port)
-
-        with sock.lock:
-            conn.status = ConnectionState.OPEN
-            stream_id = 0
-            while not stream_id:
-                stream_id = conn.get_next_available_stream()
-                if not stream_id:
-                    time.sleep(1)
-            id = (host, port, stream_id)
-            # self.response_data[id] = RawResponse()
-            if method:
-
-                h2headers = self._build_headers('GET', url, headers)
-                # with sock.lock:
-                conn.send_headers(stream_id, h2headers, end_stream=True)
-                sock.sendall(conn.data_to_send())
-                if_break = False
-                while not if_break:
-                    try:
-                        data = sock.recv(65535)
-                    except socket.timeout:
-                        try:
-                            if self.response_data[id].completed:
-                                if_break = True
-                        except KeyError:
-                            pass
-                        continue
-                    #with sock.lock:
-                    events = conn.receive_data(data)
-                    received = {}
-                    # print(events)
-                    for e in events:
-                        if isinstance(e, (HeadersReceived, DataReceived)):
-                            if e.end_stream:
-                                try:
-                                    with self.response_data[(host, port, e.stream_id)].lock:
-                                        self.response_data[(host, port, e.stream_id)].completed = True
-                                except KeyError:
-                                    self.response_data[(host, port, e.stream_id)] = RawResponse()
-                                    with self.response_data[(host, port, e.stream_id)].lock:
-                                        self.response_data[(host, port, e.stream_id)].completed = True
-                                # self.response_data[url].compeleted = True
-                                if e.stream_id == stream_id:
-                                    if_break = True
-                            if isinstance(e, HeadersReceived) :
-                                try:
-                                    with self.response_data[(host, port, e.stream_id)].lock:
-                                        self.response_data[(host, port, e.stream_id)].headers = e.headers
-                                except KeyError:
-                                    self.response_data[(host, port, e.stream_id)] = RawResponse()
-                                    with self.response_data[(host, port, e.stream_id)].lock:
-                                        self.response_data[(host, port, e.stream_id)].headers = e.headers
-
-                            if isinstance(e,DataReceived):
-                                if e.data:
-                                    try:
-                                        with self.response_data[(host, port, e.stream_id)].lock:
-                                            self.response_data[(host,port,e.stream_id)].data += e.data
-                                    except KeyError:
-
-                                        self.response_data[(host, port, e.stream_id)] = RawResponse()
-                                        with self.response_data[(host, port, e.stream_id)].lock:
-                                            self.response_data[(host, port, e.stream_id)].data += e.data
-
-                                    # self.response_data[url].data += e.data
-
-                                try:
-                                    received[e.stream_id] += e.flow_window_length
-                                except KeyError:
-                                    received[e.stream_id] = e.flow_window_length
-                    for sid, ack_len in received.items():
-                        conn.ack_data_received(ack_len,sid)
-                        sock.sendall(conn.data_to_send())
-                r = self.response_data.pop(id)
-                response = H2Response(r.headers, r.data)
-                sock.refresh_wait_time()
-        conn.status = ConnectionState.CLOSED
-        return response
+    def _can_replay(self, method, error, replays):
+        # 只重放对端明确未处理的幂等请求
+        return (isinstance(error, UnprocessedStreamError)
+                and method in self.IDEMPOTENT_METHODS
+                and replays < self.MAX_REPLAYS)
 
-    def _build_headers(self,method, url, headers: dict):
-        # 构建请求头部
-        h2headers = self.DEFAULT_HEADERS
+    def _build_request(self, method, url, headers: dict):
+        # 返回(请求模板, path)，同一服务器、同一组自定义头部的请求共用一个模板
         host = self._parse_host(url)
-        path = self._parse_path(url)
-        if headers:
-            for k, v in headers.items():
-                h2headers[k] = v
-        h2headers[':authority'] = host
-        h2headers[':method'] = method
-        h2headers[':path'] = path
-        return h2headers
-
-    def __get_sock_conn(self, host, port=None):
-
-        if port is None:
-            port = 443
-        sock_conn = self.__socks_conns.get((host, port), None)
-        # 获取失败，说明此时连接器内部可用连接对为空，也可能满，也可能不空不满仅无对应连接对
-        if not sock_conn:
-            sock = H2Socket(host, port, timeout=self.timeout)
-            conn = H2Connection()
-            conn.initiate_connection()
-            sock_conn = (sock, conn)
-            # 满的情况，删除最大挂起时间的连接对
-            if len(self.__socks_conns.keys()) >= self.max_connection:
-                max_sock_conn = None
-                while not max_sock_conn:
-                    max_sock_conn = self.__get_max_time_sock_conn()
-                    if not max_sock_conn:
-                        time.sleep(1)
-                ip_port, (sock, conn) = max_sock_conn
-                # 断开连接
-                conn.close_connection()
-                try:
-                    sock.sendall(conn.data_to_send())
-                except:
-                    traceback.print_exc()
-                # with sock.lock:
-                #     sock.close()
-                try:
-                    self.__socks_conns.pop(ip_port)
-                except KeyError:
-                    pass
-            # # 添加新连接对
-            self.__socks_conns[(host, port)] = sock_conn
-        # 验证可用性
-        try:
-            sock, conn = sock_conn
-            conn.send_ping()
-            sock.sendall(conn.data_to_send())
-        except socket.error:
-            sock_conn = self.__get_sock_conn(host,port)
-        return sock_conn
-
-    def __get_max_time_sock_conn(self):
-        # 取出当前挂起最久的[(ip, port),[socket,conn,lock]]
-        sock_list = sorted(self.__socks_conns.items(),
-                           key=lambda x:x[1][0].time_wait,
-                           reverse=True)
-        sock_conn = None
-        for ip_port, c_s in sock_list:
-            if c_s[1].status == ConnectionState.CLOSED:
-                return (ip_port, c_s)
-        return sock_conn
-
-    def get(self,url,headers=None, proxy = None):
-        # get请求
-        return self.request(method='GET',url=url, headers=headers,proxy=proxy)
-
-    def post(self, url, headers=None):
-        return self.request('POST', url, headers)
+        key = (method, host, tuple(headers.items()) if headers else ())
+        template = self.__templates.get(key)
+        if template is None:
+            # 合并到默认头部的副本中，DEFAULT_HEADERS本身不被修改
+            h2headers = dict(self.DEFAULT_HEADERS)
+            if headers:
+                h2headers.update(headers)
+            template = RequestTemplate(method, host, h2headers.items())
+            if len(self.__templates) >= self.MAX_TEMPLATES:
+                self.__templates.clear()
+            self.__templates[key] = template
+        return template, self._parse_path(url)
 
     def _parse_host(self, url):
 
@@ -393,6 +1047,312 @@ class H2Spider(object):
         return path
 
 
+# h2请求的封装，类似h1中的request
+class H2Spider(BaseSpider):
+    # h2请求的处理爬虫
+
+    # max_connection: 所有服务器的连接总数上限
+    # connections_per_origin: 同一服务器最多同时使用的连接数
+    # idle_timeout/ping_interval/ping_timeout: 连接保活参数（秒），见KeepaliveManager
+    # max_content_size/hpack_policy: 见BaseSpider
+    def __init__(self, max_connection=4, timeout=1, connections_per_origin=2,
+                 idle_timeout=300, ping_interval=30, ping_timeout=10,
+                 max_content_size=None, hpack_policy=None):
+        super(H2Spider,self).__init__(max_connection=max_connection, timeout=timeout,
+                                      max_content_size=max_content_size,
+                                      hpack_policy=hpack_policy)
+        # {(host, port): [H2Session, ...]}
+        self.__socks_conns = {}
+        # 正在建立中的连接数 {(host, port): count}
+        self.__connecting = collections.Counter()
+        self.__sessions_lock = threading.RLock()
+        self.__sessions_changed = threading.Condition(self.__sessions_lock)
+        # 负责所有连接读写的io循环，首次建立连接时创建
+        self.loop = None
+        self.connections_per_origin = connections_per_origin
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.keepalive = None
+
+    # stream: 为True时头部到达即返回H2StreamingResponse，响应体通过iter_content/iter_lines读取
+    # data: 请求体，可以是bytes、str、文件对象或产生bytes的迭代器
+    def request(self,method,url=None, headers=None, proxy = None, stream=False, data=None):
+        method = method.upper()
+        session, r = self._perform(method, url, headers, stream=stream, data=data)
+        if stream:
+            return H2StreamingResponse(session, r)
+        response = H2Response(r.headers, r.data, self.max_content_size)
+        return response
+
+    def download(self, url, path, headers=None):
+        # 下载到文件：按流式读取接收响应体，解压和写入文件都在调用线程中进行，不阻塞io循环；
+        # 尚未写入的数据受流量窗口限制，响应体不在内存中保留。有content-length时预先分配空间，
+        # 返回以mmap访问文件内容的H2FileResponse
+        try:
+            with open(path, 'wb') as fp:
+                session, r = self._perform('GET', url, headers, stream=True)
+                with H2StreamingResponse(session, r) as response:
+                    length = response.headers.get('content-length')
+                    preallocated = 0
+                    if response.decoder.passthrough and length and length.isdigit():
+                        preallocated = _preallocate(fp, int(length), self.max_content_size)
+                    size = 0
+                    for chunk in response.iter_content():
+                        fp.write(chunk)
+                        size += len(chunk)
+                    if preallocated and preallocated != size:
+                        # 实际长度与content-length不一致时去掉多余的预分配空间
+                        fp.truncate(size)
+        except:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return H2FileResponse(r.headers, path)
+
+    def _perform(self, method, url, headers, stream=False, data=None):
+        # 发送请求并等待响应（流式读取时为等待头部到达），返回(H2Session, RawResponse)
+        host = self._parse_host(url)
+        port = self._parse_port(url)
+        #print(host,port)
+        template, path = self._build_request(method, url, headers)
+        body = RequestBody(data) if data is not None else None
+        replays = 0
+        while True:
+            try:
+                session = self.__pick_session(host, port)
+                r = session.submit(template, path, body=body, streaming=stream,
+                                   max_size=self.max_content_size)
+                # 由io循环在流结束（流式读取时为头部到达）时唤醒，无需持有连接锁等待
+                if stream:
+                    r.wait_headers()
+                else:
+                    r.wait()
+                error = r.error
+            except (OSError, ValueError) as e:
+                error = e
+            if error is None:
+                break
+            if not self._can_replay(method, error, replays) or (body is not None and not body.rewind()):
+                raise error
+            # 连接收到goaway，请求未被处理，在新连接上重放
+            replays += 1
+            logging.info('replay %s %s(%s). ' % (method, url, error))
+        return session, r
+
+    def get_many(self, urls, headers=None, concurrency=None, callback=None):
+        # 批量get请求：按(host, port)分组，每组在同一连接上并发发送，流数量受对端限制
+        # concurrency: 同时进行中的请求总数上限，None表示仅受对端MAX_CONCURRENT_STREAMS限制
+        # 未指定callback时返回按完成顺序产生(url, response, error)的迭代器，
+        # 指定callback时按完成顺序调用callback(url, response, error)，全部完成后返回
+        results = self._submit_many(urls, headers, concurrency)
+        if callback is None:
+            return results
+        for url, response, error in results:
+            callback(url, response, error)
+
+    def _submit_many(self, urls, headers, concurrency):
+        groups = collections.OrderedDict()
+        for url in urls:
+            origin = (self._parse_host(url), self._parse_port(url))
+            groups.setdefault(origin, []).append(url)
+        total = sum(len(group) for group in groups.values())
+        # 已完成的(url, RawResponse或None, error)
+        done = queue.Queue()
+        limiter = threading.BoundedSemaphore(concurrency) if concurrency else None
+
+        def finish(url, r, error):
+            if limiter:
+                limiter.release()
+            done.put((url, r, error))
+
+        def on_done(origin, url, replays, r):
+            # 在io循环中被调用，任何异常都作为该请求的结果交给使用者，保证每个url都有结果
+            try:
+                if self._can_replay('GET', r.error, replays):
+                    # 重放可能需要建立新连接，交由新线程执行
+                    threading.Thread(target=submit, args=(origin, url, replays + 1),
+                                     daemon=True).start()
+                    return
+            except Exception as e:
+                finish(url, None, e)
+                return
+            finish(url, r, r.error)
+
+        def submit(origin, url, replays=0):
+            # 每个请求单独选择连接，请求会分散到该服务器的多个连接上
+            while True:
+                try:
+                    session = self.__pick_session(*origin)
+                    r = session.submit(*self._build_request('GET', url, headers),
+                                       max_size=self.max_content_size)
+                except Exception as e:
+                    if self._can_replay('GET', e, replays):
+                        replays += 1
+                        continue
+                    finish(url, None, e)
+                    return
+                r.add_done_callback(functools.partial(on_done, origin, url, replays))
+                return
+
+        def feed(origin, group):
+            # 每个服务器一个发送线程，某个服务器的流名额耗尽时不影响其他服务器
+            for url in group:
+                if limiter:
+                    limiter.acquire()
+                submit(origin, url)
+
+        for origin, group in groups.items():
+            threading.Thread(target=feed, args=(origin, group), daemon=True).start()
+        return self._iter_results(done, total)
+
+    def _iter_results(self, done, total):
+        # 每个url恰好对应done中的一个结果（成功、出错或发送失败），io循环和发送线程放入后
+        # 在使用者的线程中按完成顺序产生，出错的请求以(url, None, error)产生
+        for _ in range(total):
+            url, r, error = done.get()
+            if error is not None:
+                yield url, None, error
+            else:
+                yield url, H2Response(r.headers, r.data, self.max_content_size), None
+
+    def another_request(self,method,url=None, headers=None, proxy = None ):
+
+        return self.request(method, url, headers, proxy)
+
+    def __pick_session(self, host, port=None):
+        # 选择负载最低的连接；该连接没有空闲的流名额且连接数未达到connections_per_origin时建立新连接
+        if port is None:
+            port = 443
+        origin = (host, port)
+        with self.__sessions_lock:
+            while True:
+                sessions = self.__live_sessions(origin)
+                connecting = self.__connecting[origin]
+                best = min(sessions, key=lambda x: x.load) if sessions else None
+                if best is not None and (best.admission.free_slots
+                                         or len(sessions) + connecting >= self.connections_per_origin):
+                    return best
+                if best is None and connecting >= self.connections_per_origin:
+                    # 连接都在建立中，等待其完成
+                    self.__sessions_changed.wait()
+                    continue
+                break
+            self.__connecting[origin] += 1
+            self.__evict_idle(reserve=1)
+            if self.loop is None:
+                self.loop = IOLoop()
+                self.keepalive = KeepaliveManager(self, self.loop,
+                                                  idle_timeout=self.idle_timeout,
+                                                  ping_interval=self.ping_interval,
+                                                  ping_timeout=self.ping_timeout)
+                self.keepalive.start()
+            loop = self.loop
+        # 建立连接（TLS握手）时不持有锁，避免阻塞其他服务器的请求
+        try:
+            session = H2Session(host, port, loop, timeout=self.timeout,
+                                hpack_policy=self.hpack_policy)
+        finally:
+            with self.__sessions_lock:
+                self.__connecting[origin] -= 1
+                if not self.__connecting[origin]:
+                    del self.__connecting[origin]
+                self.__sessions_changed.notify_all()
+        with self.__sessions_lock:
+            self.__socks_conns.setdefault(origin, []).append(session)
+        return session
+
+    def __live_sessions(self, origin):
+        # 调用时需持有self.__sessions_lock，从连接池中移除已不可用的连接
+        # 收到goaway的连接在已接受的请求完成后会自行关闭，这里不主动关闭
+        sessions = self.__socks_conns.get(origin, [])
+        live = [session for session in sessions if session.usable]
+        if len(live) != len(sessions):
+            if live:
+                self.__socks_conns[origin] = live
+            else:
+                self.__socks_conns.pop(origin, None)
+        return live
+
+    def __evict_idle(self, reserve=0):
+        # 调用时需持有self.__sessions_lock
+        # 连接总数（加上reserve个即将建立的连接）超过max_connection时，按空闲时间从长到短关闭空闲连接；
+        # 没有空闲连接时允许暂时超出上限，待连接空闲后再回收，不进行等待
+        total = sum(len(sessions) for sessions in self.__socks_conns.values())
+        total += sum(self.__connecting.values()) - 1 + reserve
+        if total <= self.max_connection:
+            return
+        idle = sorted((session.last_active, origin, session)
+                      for origin, sessions in self.__socks_conns.items()
+                      for session in sessions
+                      if not session.active_count)
+        for _, origin, session in idle[:total - self.max_connection]:
+            self.__socks_conns[origin].remove(session)
+            if not self.__socks_conns[origin]:
+                del self.__socks_conns[origin]
+            try:
+                session.close()
+            except:
+                traceback.print_exc()
+
+    def _pooled_sessions(self):
+        # 连接池中所有连接的快照
+        with self.__sessions_lock:
+            return [session for sessions in self.__socks_conns.values() for session in sessions]
+
+    def _drop_session(self, session, replace=False):
+        # 将连接移出连接池并关闭；replace为True时在后台为该服务器重新建立连接
+        origin = (session.host, session.port)
+        with self.__sessions_lock:
+            sessions = self.__socks_conns.get(origin, [])
+            if session in sessions:
+                sessions.remove(session)
+                if not sessions:
+                    del self.__socks_conns[origin]
+        session.close()
+        if replace:
+            threading.Thread(target=self.__replace_session, args=origin, daemon=True).start()
+
+    def header_stats(self):
+        # 连接池中各连接的头部压缩统计 {(host, port): [统计, ...]}，见H2Connection.header_stats
+        stats = {}
+        for session in self._pooled_sessions():
+            with session.lock:
+                stats.setdefault((session.host, session.port), []).append(session.conn.header_stats())
+        return stats
+
+    def __replace_session(self, host, port):
+        try:
+            self.__pick_session(host, port)
+        except (OSError, ValueError) as e:
+            logging.info('reconnect to %s:%s failed: %s' % (host, port, e))
+
+    def close(self):
+        # 关闭所有连接并停止io循环
+        with self.__sessions_lock:
+            sessions, self.__socks_conns = self.__socks_conns, {}
+            loop, self.loop = self.loop, None
+            keepalive, self.keepalive = self.keepalive, None
+        if keepalive is not None:
+            loop.call_soon_threadsafe(keepalive.stop)
+        for origin_sessions in sessions.values():
+            for session in origin_sessions:
+                session.close()
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+
+    def get(self,url,headers=None, proxy = None, stream=False):
+        # get请求
+        return self.request(method='GET',url=url, headers=headers,proxy=proxy, stream=stream)
+
+    # headers保持为第二个位置参数（与早期版本的post(url, headers)兼容），请求体通过data关键字参数传入
+    def post(self, url, headers=None, data=None):
+        return self.request('POST', url, headers, data=data)
+
+    def put(self, url, headers=None, data=None):
+        return self.request('PUT', url, headers, data=data)
+
+
 if __name__ == '__main__':
     pass
 
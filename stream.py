@@ -7,15 +7,13 @@ try:
     from .events import *
 except:
     from events import *
-from enum import Enum
 import logging, logconfig
-from windows import WindowManager
 
 # 流管理器（暂定，实际处理应该在h2connection中）
 # 以及流对象的创建
 
-# 流状态
-class StreamState(Enum):
+# 流状态（使用小整数，便于直接索引状态转换表）
+class StreamState(object):
     IDLE = 0
     RESERVED_REMOTE = 1
     RESERVED_LOCAL = 2
@@ -26,7 +24,7 @@ class StreamState(Enum):
 
 
 # 流行为
-class StreamActions(Enum):
+class StreamActions(object):
     SEND_HEADERS = 0
     SEND_PUSH_PROMISE = 1
     SEND_RST_STREAM = 2
@@ -47,6 +45,10 @@ class StreamActions(Enum):
     UPGRADE_CLIENT = 17
 
 
+_STATE_COUNT = 7
+_ACTION_COUNT = 18
+
+
 # 流的状态转换表
 #                          +--------+
 #                  send PP |        | recv PP
@@ -90,6 +92,8 @@ _transitions = {
     (StreamState.IDLE, StreamActions.SEND_PUSH_PROMISE): StreamState.RESERVED_LOCAL,
     (StreamState.IDLE, StreamActions.RECV_PUSH_PROMISE): StreamState.RESERVED_REMOTE,
     # OPEN
+    # 对端可以在本端上传请求体的过程中先发出响应头部（如提前拒绝或100 Continue），流保持OPEN
+    (StreamState.OPEN, StreamActions.RECV_HEADERS): StreamState.OPEN,
     (StreamState.OPEN, StreamActions.SEND_END_STREAM): StreamState.HALF_CLOSED_LOCAL,
     (StreamState.OPEN, StreamActions.RECV_END_STREAM): StreamState.HALF_CLOSED_REMOTE,
     (StreamState.OPEN, StreamActions.SEND_RST_STREAM): StreamState.CLOSED,
@@ -114,12 +118,24 @@ _transitions = {
 
 }
 
+# 由_transitions预先展开的转换表，以state * _ACTION_COUNT + action为下标，-1表示非法转换
+_TRANSITION_TABLE = [-1] * (_STATE_COUNT * _ACTION_COUNT)
+for (_state, _action), _new_state in _transitions.items():
+    _TRANSITION_TABLE[_state * _ACTION_COUNT + _action] = _new_state
+
 
 class H2Stream(object):
+    # 高并发下流对象数量很多，使用__slots__并将窗口计数直接保存在流对象上
+    __slots__ = ('stream_id', 'status',
+                 'outbound_window_size',
+                 'inbound_window_size',
+                 'inbound_current_window',
+                 'inbound_bytes_processed',
+                 'max_outbound_frame_size',
+                 'max_inbound_frame_size')
 
-    status = StreamState.IDLE
     # outbound_window_size: 发送的数据的流动窗口大小
-    # inbound_window_size: 接收数据的流动窗口大小
+    # inbound_window_size: 接收数据的流动窗口大小（最大值）
     def __init__(self,
                  stream_id,
                  outbound_window_size,
@@ -127,15 +143,25 @@ class H2Stream(object):
                  max_outbound_frame_size,
                  max_inbound_frame_size):
         self.stream_id = stream_id
+        self.status = StreamState.IDLE
         self.outbound_window_size = outbound_window_size
         self.inbound_window_size = inbound_window_size
-        self.inbound_window_manager = WindowManager(inbound_window_size)
+        # 当前接收窗口，以及已处理但尚未通知对端的字节数
+        self.inbound_current_window = inbound_window_size
+        self.inbound_bytes_processed = 0
         # max_outbound_frame_size: 本端发送帧的最大payload长度，
         # 即对端接收帧的最大payload长度（根据对端的Settings帧以及WindowUpdate帧进行设置）
         # max_inbound_frame_size:  本端接收帧的最大payload长度（由本端需求进行配置）
         self.max_outbound_frame_size = max_outbound_frame_size
         self.max_inbound_frame_size = max_inbound_frame_size
 
+    def _transition(self, action):
+        new_status = _TRANSITION_TABLE[self.status * _ACTION_COUNT + action]
+        if new_status < 0:
+            raise ValueError('invalid stream(%s) transition: state %s, action %s.'
+                             % (self.stream_id, self.status, action))
+        self.status = new_status
+
     def send_headers(self, headers: dict,
                      encoder,
                      end_stream=False,
@@ -148,6 +174,24 @@ class H2Stream(object):
 
         # 将headers数据按照大小限制进行格式化封帧返回
         # 返回包含headers帧和continuation帧的列表
+        return self.send_header_block(encoder.encode(headers),
+                                      end_stream,
+                                      padded,
+                                      padded_length,
+                                      priority,
+                                      exclusive,
+                                      stream_dependency,
+                                      weight)
+
+    def send_header_block(self, headers_payload,
+                          end_stream=False,
+                          padded=False,
+                          padded_length=0,
+                          priority=False,
+                          exclusive=False,
+                          stream_dependency=0x0,
+                          weight=16):
+        # 发送已完成hpack编码的头部块
         headers_flags = set()
         frames = []
         others_length = 0
@@ -164,7 +208,6 @@ class H2Stream(object):
                              f'stream({self.stream_id}).max_outbound_frame_size is not enough. ')
         place = self.max_outbound_frame_size - others_length
         headers_flags = tuple(headers_flags)
-        headers_payload = encoder.encode(headers)
         first_block = headers_payload[0:place]
         continuation_blocks = []
         if place < len(headers_payload):
@@ -183,52 +226,66 @@ class H2Stream(object):
                           weight=weight
                           )
         frames.append(hf)
-        for block in continuation_blocks[1:]:
+        for block in continuation_blocks:
             cf = ContinuationFrame(self.stream_id, block)
             frames.append(cf)
         frames[-1].add_flag('END_HEADERS')
-        old_status = self.status
-        self.status = _transitions[(old_status, StreamActions.SEND_HEADERS)]
+        self._transition(StreamActions.SEND_HEADERS)
         if end_stream:
-            old_status = self.status
-            self.status = _transitions[(old_status, StreamActions.SEND_END_STREAM)]
+            self._transition(StreamActions.SEND_END_STREAM)
         return frames
 
+    def send_data(self, data, end_stream=False):
+        # 发送一个DATA帧，由调用方保证data不超过发送窗口和对端的最大帧长度
+        if self.status not in (StreamState.OPEN, StreamState.HALF_CLOSED_REMOTE):
+            raise ValueError('stream %s can not send data in state %s. ' % (self.stream_id, self.status))
+        self.outbound_window_size -= len(data)
+        if end_stream:
+            self._transition(StreamActions.SEND_END_STREAM)
+            return DataFrame(self.stream_id, data, flags=('END_STREAM',))
+        return DataFrame(self.stream_id, data)
+
     def receive_headers(self, frame, decoder):
 
         # 客户端默认接收到的是服务器的响应头
         event = HeadersReceived()
         event.stream_id = self.stream_id
         event.headers = decoder.decode((frame.data))
-        if 'END_STREAM' in frame.flags:
+        self._transition(StreamActions.RECV_HEADERS)
+        if frame.flag_bits & FLAG_END_STREAM:
             event.end_stream = True
-        old_status = self.status
-        self.status = _transitions[old_status, StreamActions.RECV_HEADERS]
+            self._transition(StreamActions.RECV_END_STREAM)
         return event
 
     def receive_data(self, frame: DataFrame):
-        event = DataReceived()
+        # 事件只持有payload的视图，由使用者决定是否复制
+        event = DataReceived(frame.data)
         event.stream_id = frame.stream_id
-        event.data = frame.data
         event.flow_window_length = frame.body_len
-        if 'END_STREAM' in frame.flags:
+        self.inbound_current_window -= frame.body_len
+        if self.inbound_current_window < 0:
+            raise ValueError('current windows below 0. ')
+        if frame.flag_bits & FLAG_END_STREAM:
             event.end_stream = True
-        self.inbound_window_manager.current_window_reduce(frame.body_len)
+            self._transition(StreamActions.RECV_END_STREAM)
         return event
 
     def ack_data_received(self,received_size):
-        increment = self.inbound_window_manager.process_bytes(received_size)
-        #print('stream increment:%s,current size:%s'%(increment,self.inbound_window_manager.current_window_size))
-        if increment:
-            wf = WindowUpdateFrame(self.stream_id, increment)
-            return wf
-        return []
+        # 返回需要通知对端的窗口增量，无需更新时返回0
+        # 与WindowManager.process_bytes相同：已处理字节超过窗口的一半时恢复窗口
+        self.inbound_bytes_processed += received_size
+        if self.inbound_bytes_processed <= (self.inbound_window_size // 2):
+            return 0
+        increment = min(self.inbound_bytes_processed,
+                        self.inbound_window_size - self.inbound_current_window)
+        self.inbound_bytes_processed = 0
+        self.inbound_current_window += increment
+        return increment
 
     def receive_rst_stream(self, frame: RstStreamFrame):
 
         event = RstStreamReceived()
         event.stream_id = frame.stream_id
         event.error_code = frame.error_code
-        old_status = self.status
-        self.status = _transitions[(old_status, StreamActions.RECV_RST_STREAM)]
+        self._transition(StreamActions.RECV_RST_STREAM)
         return event
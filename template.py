@@ -0,0 +1,40 @@
+# 请求模板：同一服务器、同一组自定义头部的请求之间只有:path不同。
+# 模板创建后不再改变，伪头部按method、scheme、authority的顺序排在普通头部之前，
+# H2Connection据此缓存模板中不变部分的hpack编码结果，每个请求只需编码:path
+
+
+class RequestTemplate(object):
+    __slots__ = ('pseudo_headers', 'headers', 'size', '_hash')
+
+    # headers: (name, value)的序列，其中以':'开头的视为伪头部；:path由每个请求单独给出，这里忽略
+    def __init__(self, method, authority, headers=()):
+        pseudo = {':method': method, ':scheme': 'https', ':authority': authority}
+        regular = []
+        for name, value in headers:
+            if not name.startswith(':'):
+                regular.append((name, value))
+            elif name not in (':path', ':method', ':authority'):
+                pseudo[name] = value
+        self.pseudo_headers = tuple(pseudo.items())
+        self.headers = tuple(regular)
+        # 不含:path的头部字节数（名称与值的长度之和），用于头部压缩统计
+        self.size = sum(len(name) + len(value) for name, value in self.pseudo_headers + self.headers)
+        self._hash = hash((self.pseudo_headers, self.headers))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, RequestTemplate):
+            return NotImplemented
+        return (self._hash == other._hash and self.pseudo_headers == other.pseudo_headers
+                and self.headers == other.headers)
+
+    def __repr__(self):
+        return '<RequestTemplate %s>' % (dict(self.pseudo_headers),)
+
+    def build(self, path):
+        # 完整的请求头部列表，伪头部在前
+        return self.pseudo_headers + ((':path', path),) + self.headers
@@ -0,0 +1,38 @@
+import io
+import unittest
+
+from body import RequestBody
+
+
+class RequestBodyTest(unittest.TestCase):
+
+    def test_bytes(self):
+        body = RequestBody(b'abc')
+        self.assertEqual(body.length, 3)
+        self.assertEqual(b''.join(bytes(chunk) for chunk in body.chunks()), b'abc')
+        self.assertEqual(body.headers(), (('content-length', '3'),))
+
+    def test_file(self):
+        body = RequestBody(io.BytesIO(b'x' * 100))
+        self.assertEqual(b''.join(body.chunks()), b'x' * 100)
+        self.assertTrue(body.rewind())
+        self.assertEqual(b''.join(body.chunks()), b'x' * 100)
+
+    def test_iterator(self):
+        body = RequestBody(iter([b'a', 'b', b'']))
+        self.assertIsNone(body.length)
+        self.assertEqual(list(body.chunks()), [b'a', b'b'])
+        self.assertEqual(body.headers(), ())
+
+    def test_mapping_rejected(self):
+        # 字典的键不能被当作请求体发送
+        with self.assertRaises(TypeError):
+            RequestBody({'a': '1', 'bb': '2'})
+
+    def test_unsupported_type(self):
+        with self.assertRaises(ValueError):
+            RequestBody(123)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from hpack.hpack import Encoder
+
+from connection import H2Connection
+from frame import *
+from events import *
+from stream import StreamState
+from template import RequestTemplate
+
+# 不涉及网络的流状态测试：直接向H2Connection输入服务器端的帧
+
+
+class ResponseDuringUploadTest(unittest.TestCase):
+    # 请求体尚未上传完（受流量窗口限制）时，服务器先发出了响应
+
+    def setUp(self):
+        self.conn = H2Connection()
+        self.conn.initiate_connection()
+        self.conn.receive_data(SettingsFrame(0).serialize())
+        self.encoder = Encoder()
+        self.stream_id = self.conn.get_next_available_stream()
+        template = RequestTemplate('POST', 'localhost')
+        self.conn.send_request_headers(self.stream_id, template, '/upload')
+        # 超过默认的65535字节发送窗口，剩余部分排队等待WINDOW_UPDATE
+        self.conn.send_data(self.stream_id, b'x' * 100000)
+        self.conn.data_to_send()
+        self.assertGreater(self.conn.pending_data_size(self.stream_id), 0)
+
+    def _headers(self, status, end_stream=False):
+        flags = ('END_HEADERS', 'END_STREAM') if end_stream else ('END_HEADERS',)
+        return HeadersFrame(self.stream_id, self.encoder.encode([(':status', status)]),
+                            flags=flags).serialize()
+
+    def test_headers_keep_stream_open(self):
+        events = self.conn.receive_data(self._headers('100'))
+        self.assertEqual([type(e) for e in events], [HeadersReceived])
+        self.assertEqual(self.conn.streams[self.stream_id].status, StreamState.OPEN)
+        # 上传可以继续
+        self.conn.receive_data(WindowUpdateFrame(0, 65535).serialize() +
+                               WindowUpdateFrame(self.stream_id, 65535).serialize())
+        self.conn.send_data(self.stream_id, b'', end_stream=True)
+        self.assertEqual(self.conn.pending_data_size(self.stream_id), 0)
+        self.assertEqual(self.conn.streams[self.stream_id].status, StreamState.HALF_CLOSED_LOCAL)
+
+    def test_headers_with_end_stream(self):
+        events = self.conn.receive_data(self._headers('413', end_stream=True))
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0], HeadersReceived)
+        self.assertTrue(events[0].end_stream)
+        self.assertEqual(self.conn.streams[self.stream_id].status, StreamState.HALF_CLOSED_REMOTE)
+
+    def test_response_body_ends_stream(self):
+        self.conn.receive_data(self._headers('200'))
+        events = self.conn.receive_data(DataFrame(self.stream_id, b'done', flags=('END_STREAM',)).serialize())
+        self.assertIsInstance(events[0], DataReceived)
+        self.assertTrue(events[0].end_stream)
+        self.assertEqual(self.conn.streams[self.stream_id].status, StreamState.HALF_CLOSED_REMOTE)
+        # 本端结束上传后流关闭
+        self.conn.receive_data(WindowUpdateFrame(0, 65535).serialize() +
+                               WindowUpdateFrame(self.stream_id, 65535).serialize())
+        events = self.conn.send_data(self.stream_id, b'', end_stream=True)
+        self.assertEqual([type(e) for e in events], [StreamClosed])
+        self.assertNotIn(self.stream_id, self.conn.streams)
+
+
+if __name__ == '__main__':
+    unittest.main()